@@ -1,54 +1,123 @@
 # ai_service.py
-import os
 import asyncio
-from typing import List, Dict, Optional
-from openai import AsyncOpenAI
+import functools
+import hashlib
+import json
+from pathlib import Path
+from typing import AsyncIterator, List, Dict, Optional
+import httpx
+from openai import AsyncOpenAI, APITimeoutError
 import logging
-from config import settings
+from config import get_settings
 #from groq import AsyncGroq
+try:
+    import zstandard
+except ImportError:  # сжатые промпты необязательны
+    zstandard = None
 
 logger = logging.getLogger(__name__)
+settings = get_settings()
+
+PROMPT_PATH = "docs/bot_instructions_non_RAG.txt"
+PROMPT_PATH_RAG = "docs/bot_instructions_for_rag.txt"
+
+# Та же модель эмбеддингов, что и в RAG, чтобы эмбеддинг вопроса можно было переиспользовать
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# Инструкция для сжатия старой части диалога в резюме
+SUMMARY_PROMPT = (
+    "Compress the conversation below into at most 200 tokens of facts about the user and their questions. "
+    "Keep names, numbers and decisions. Reply with the summary only."
+)
+SUMMARY_MAX_TOKENS = 250
+
+# Тексты-заглушки при ошибках: такие ответы не сохраняются в семантический кэш
+AI_TIMEOUT_MESSAGE = "⏳ Sorry, the response is taking longer than expected. Please try again later or use the menu buttons."
+AI_UNAVAILABLE_MESSAGE = "The AI assistant is currently unavailable. Please use the menu buttons or try again later."
+AI_ERROR_MESSAGES = frozenset((AI_TIMEOUT_MESSAGE, AI_UNAVAILABLE_MESSAGE))
+
+# 1 ============== Загрузка промптов из папки docs/ ==============
+
+@functools.lru_cache(maxsize=4)
+def _read_prompt(path: str) -> str:
+    """
+    Читает системный промпт с диска один раз, дальше отдаёт из кэша.
+    Если рядом лежит сжатая копия <path>.zst и установлен zstandard, читается она.
+    """
+    try:
+        compressed = Path(path + ".zst")
+        if zstandard is not None and compressed.exists():
+            return zstandard.ZstdDecompressor().decompress(compressed.read_bytes()).decode('utf-8')
+        return Path(path).read_bytes().decode('utf-8')
+    except FileNotFoundError:
+        logger.error(f"Файл промпта не найден: {path}")
+    except Exception as e:
+        logger.error(f"Error loading system prompt {path}: {e}")
+    return ""
+
+
+# Прогреваем кэш при импорте, чтобы первый запрос пользователя не ходил на диск
+_read_prompt(PROMPT_PATH)
+_read_prompt(PROMPT_PATH_RAG)
+
 
 class OpenAIAssistant:
+    # Сколько последних сообщений истории отправляем в модель (3 пары вопрос-ответ)
+    _HISTORY_LIMIT = 6
+
     def __init__(self):
         if not settings.OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY not configured")
 
-        self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        # Один HTTP-клиент на весь процесс: keep-alive соединения с OpenAI переиспользуются
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=32, keepalive_expiry=60),
+            timeout=httpx.Timeout(15.0, connect=5.0),
+            http2=True
+        )
+        self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, http_client=self.http_client)
         #self.client = AsyncGroq(api_key=settings.OPENAI_API_KEY)
 
         self.model = settings.AI_MODEL
         self.max_tokens = settings.AI_MAX_TOKENS
         self.temperature = settings.AI_TEMPERATURE
-        self.system_prompt = self._load_system_prompt()
-        self.system_prompt_rag = self._load_system_prompt_rag()
+        self.system_prompt = _read_prompt(PROMPT_PATH)
+        self.system_prompt_rag = _read_prompt(PROMPT_PATH_RAG)
+        # Системные сообщения собираем один раз; в get_response они не изменяются
+        self._system_msg = {"role": "system", "content": self.system_prompt}
+        self._system_msg_rag = {"role": "system", "content": self.system_prompt_rag}
+
+        # Ограничение одновременных запросов к OpenAI (единственное на процесс: обработчики своего не держат)
+        # и склейка одинаковых запросов "в полёте"
+        self._sem = asyncio.Semaphore(settings.AI_MAX_CONCURRENCY)
+        self._inflight: Dict[str, asyncio.Future] = {}
         logger.info(f"AI Assistant initialized with model: {self.model}")
 
-# 1 ============== Загрузка промпта из файла docs/bot_instructions.txt ==============
+# 2================= Сборка сообщений для модели  ===============================
 
-    def _load_system_prompt(self) -> str:
-        """Загружаем системный промпт из файла"""
-        try:
-            prompt_path = "docs/bot_instructions_non_RAG.txt"
-            if os.path.exists(prompt_path):
-                with open(prompt_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            else:
-                logger.error(f"Ошибка чтения файла docs/bot_instructions.txt : {e}")
-        except Exception as e:
-            logger.error(f"Error loading system prompt: {e}")
+    def _build_messages(
+            self,
+            user_message: str,
+            history: Optional[List[Dict]],
+            RAG: bool,
+            summary: Optional[str] = None
+    ) -> List[Dict]:
+        """Системный промпт + резюме старого диалога + последние сообщения истории + текущий вопрос"""
+        messages = [self._system_msg_rag if RAG else self._system_msg]
 
-    def _load_system_prompt_rag(self) -> str:
-        """Загружаем системный промпт для раг использования"""
-        try:
-            prompt_path = "docs/bot_instructions_for_rag.txt"
-            if os.path.exists(prompt_path):
-                with open(prompt_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            else:
-                logger.error(f"Ошибка чтения файла docs/bot_instructions_for_rag.txt : {e}")
-        except Exception as e:
-            logger.error(f"Error loading system prompt: {e}")
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+
+        # Добавляем историю диалога (последние 3 пары вопрос-ответ)
+        if history:
+            messages.extend(history[-self._HISTORY_LIMIT:])
+
+        # Добавляем текущий вопрос
+        messages.append({"role": "user", "content": user_message})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("messages=%r", messages)
+        return messages
 
 # 3================= Запрос и ответ от ИИ  ===============================
 
@@ -58,42 +127,37 @@ class OpenAIAssistant:
             user_id: int,
             history: Optional[List[Dict]] = None,
             timeout: int = 15,
-            RAG: bool = False
+            RAG: bool = False,
+            summary: Optional[str] = None
     ) -> str:
         """Получить ответ от OpenAI"""
+        messages = self._build_messages(user_message, history, RAG, summary)
 
-        # Формируем сообщения
-        if RAG:
-            messages = [
-                {"role": "system", "content": self.system_prompt_rag}
-            ]
+        # Если такой же запрос уже выполняется, ждём его результат вместо второго вызова API
+        key = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()
+        request = self._inflight.get(key)
+        if request is None:
+            request = asyncio.ensure_future(self._request(messages, user_id, timeout))
+            self._inflight[key] = request
+            request.add_done_callback(lambda _: self._inflight.pop(key, None))
         else:
-            messages = [
-                {"role": "system", "content": self.system_prompt}
-            ]
+            logger.info("Coalesced duplicate AI request for user %s", user_id)
 
-        # Добавляем историю диалога (если есть)
-        if history:
-            # Ограничиваем историю (последние 3 пары вопрос-ответ)
-            max_history = 3
-            if len(history) > max_history * 2:
-                history = history[-max_history * 2:]
-            messages.extend(history)
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(request)
 
-        # Добавляем текущий вопрос
-        messages.append({"role": "user", "content": user_message})
-        logger.info(f'{messages}')
+    async def _request(self, messages: List[Dict], user_id: int, timeout: int) -> str:
+        """Выполняет запрос к OpenAI с ограничением параллельности"""
         try:
-            # Делаем запрос к OpenAI с таймаутом
-            response = await asyncio.wait_for(
-                self.client.chat.completions.create(
+            async with self._sem:
+                # Делаем запрос к OpenAI с таймаутом на уровне HTTP-клиента
+                response = await self.client.chat.completions.create(
                     model=self.model,
                     messages=messages,
                     temperature=self.temperature,
-                    max_tokens=self.max_tokens
-                ),
-                timeout=timeout
-            )
+                    max_tokens=self.max_tokens,
+                    timeout=timeout
+                )
 
             ai_response = response.choices[0].message.content.strip()
 
@@ -101,17 +165,104 @@ class OpenAIAssistant:
             ai_response = ai_response.replace("```", "").strip()
 
             # Логируем успешный запрос
-            logger.info(f"AI response generated for user {user_id}, tokens: {response.usage.total_tokens}")
+            logger.info("AI response generated for user %s, tokens: %s", user_id, response.usage.total_tokens)
 
             return ai_response
 
-        except asyncio.TimeoutError:
-            logger.warning(f"OpenAI timeout for user {user_id}")
-            return "⏳ Sorry, the response is taking longer than expected. Please try again later or use the menu buttons."
+        except APITimeoutError:
+            logger.warning("OpenAI timeout for user %s", user_id)
+            return AI_TIMEOUT_MESSAGE
+
+        except Exception as e:
+            logger.error("OpenAI error for user %s: %s", user_id, e)
+            return AI_UNAVAILABLE_MESSAGE
+
+# 4================= Потоковый ответ от ИИ  ===============================
+
+    async def stream_response(
+            self,
+            user_message: str,
+            user_id: int,
+            history: Optional[List[Dict]] = None,
+            timeout: int = 15,
+            RAG: bool = False,
+            summary: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Отдаёт ответ OpenAI по частям по мере генерации"""
+        messages = self._build_messages(user_message, history, RAG, summary)
+        produced = False
+        try:
+            async with self._sem:
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    timeout=timeout,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        produced = True
+                        yield delta
+
+            logger.info("AI response streamed for user %s", user_id)
+
+        except APITimeoutError:
+            logger.warning("OpenAI stream timeout for user %s", user_id)
+            if not produced:
+                yield AI_TIMEOUT_MESSAGE
 
         except Exception as e:
-            logger.error(f"OpenAI error for user {user_id}: {str(e)}")
-            return "The AI assistant is currently unavailable. Please use the menu buttons or try again later."
+            logger.error("OpenAI stream error for user %s: %s", user_id, e)
+            if not produced:
+                yield AI_UNAVAILABLE_MESSAGE
+
+# 5================= Резюме старой части диалога  ===============================
+
+    async def summarize(self, messages: List[Dict], previous_summary: Optional[str] = None) -> Optional[str]:
+        """Сжимает старые сообщения (вместе с прежним резюме) в короткое резюме; None при ошибке"""
+        lines = [f"Previous summary: {previous_summary}"] if previous_summary else []
+        lines.extend(f"{m['role']}: {m['content']}" for m in messages)
+
+        try:
+            async with self._sem:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": "\n".join(lines)}
+                    ],
+                    temperature=0,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    timeout=15
+                )
+            return response.choices[0].message.content.strip()
+
+        except Exception as e:
+            logger.error("Summary error: %s", e)
+            return None
+
+# 6================= Эмбеддинг вопроса  ===============================
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """Эмбеддинг текста (для семантического кэша и поиска в RAG); None при ошибке"""
+        try:
+            response = await self.client.embeddings.create(
+                model=EMBEDDING_MODEL, input=text[:8000], dimensions=EMBEDDING_DIMENSIONS
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            logger.error("Embedding error: %s", e)
+            return None
+
+    async def aclose(self):
+        """Закрывает HTTP-клиент OpenAI"""
+        await self.http_client.aclose()
+        logger.info("✅ OpenAI HTTP client closed")
 
 
 # Создаем глобальный экземпляр для использования во всем боте
@@ -0,0 +1,36 @@
+# background.py
+# Фоновые задачи "запустил и забыл": ответ пользователю не ждёт записи статистики и т.п.
+
+import asyncio
+import logging
+from typing import Awaitable, Set
+
+logger = logging.getLogger(__name__)
+
+# Держим ссылки на задачи, иначе сборщик мусора может удалить их до завершения
+_tasks: Set[asyncio.Task] = set()
+
+
+def _on_done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed: %r", task.exception())
+
+
+def fire(coro: Awaitable) -> asyncio.Task:
+    """Запускает корутину в фоне; ошибки только логируются"""
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_on_done)
+    return task
+
+
+async def drain(timeout: float = 5.0):
+    """Ждёт незавершённые фоновые задачи при остановке бота (не дольше timeout секунд)"""
+    if not _tasks:
+        return
+    done, pending = await asyncio.wait(set(_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("⚠️ Cancelled %s unfinished background tasks", len(pending))
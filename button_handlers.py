@@ -1,5 +1,6 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, \
     ReplyKeyboardRemove
+import asyncio
 import logging
 from keyboard.keyboard import replykeyboard, inlinekeyboard
 from telegram.ext import (
@@ -11,84 +12,90 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
-from database.database import get_user_by_telegram_id, register_user
-# --- Настройка логирования ---
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    force=True
-)
+from database.database import is_registered, register_user
 logger = logging.getLogger(__name__)
 
 
-class InlineHandler:
-    async def handler_begin_registartion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        #user = update.effective_user
-        await query.answer()
-        user_id = query.from_user.id
-        username = query.from_user.username
-        logger.info(f"button_handler: action={query.data}, user_id={user_id}")
+# Клавиатуры не меняются, поэтому собираем их один раз при импорте
+_INFO_KEYBOARD = inlinekeyboard.get_info_keyboard()
+_AUTH_BEGIN_KEYBOARD = inlinekeyboard.get_auth_begin_keyboard()
+_AUTH_KEYBOARD = inlinekeyboard.get_auth_keyboard()
+
 
-        action = query.data
+async def handler_begin_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    #user = update.effective_user
+    await query.answer()
+    user_id = query.from_user.id
+    username = query.from_user.username
+    logger.info("button_handler: action=%s, user_id=%s", query.data, user_id)
 
-        try:
-            if action == "registration":
-                success, message = await register_user(user_id, username)
-                if success:
-                    await query.message.reply_text(
-                        message, reply_markup=inlinekeyboard.get_info_keyboard(),
-                        parse_mode="Markdown")
-                else:
-                    await query.message.reply_text(message)
+    action = query.data
 
-            elif action == "info":
-                registration_check = await get_user_by_telegram_id(user_id)
-                if not registration_check:
-                    await query.message.reply_text(
-                        " *Возникли вопросы? Не знаешь,Что делать?*\n\n",
-                        reply_markup=inlinekeyboard.get_auth_begin_keyboard(),
-                        parse_mode="Markdown"
-                    )
-                else:
-                    await query.message.reply_text(
-                        "*Возникли вопросы? Я помогу тебе найти на них ответы.*\n"
-                        "*Ознакомься с моими основными командами:*\n"
-                        "1. /exit - выход из системы\n",
-                        parse_mode="Markdown"
-                    )
+    try:
+        if action == "registration":
+            success, message = await register_user(user_id, username)
+            if success:
+                await query.message.reply_text(
+                    message, reply_markup=_INFO_KEYBOARD,
+                    parse_mode="Markdown")
             else:
-                await query.message.reply_text("Неизвестная команда")
-                return
-        except Exception as e:
-            logger.error(f"Error in button_handler: {e}", exc_info=True)
-            await query.message.reply_text(f"❌ Ошибка при получении данных: {e}")
+                await query.message.reply_text(message)
 
-inlinehandler = InlineHandler
+        elif action == "info":
+            registration_check = await is_registered(user_id)
+            if not registration_check:
+                await query.message.reply_text(
+                    " *Возникли вопросы? Не знаешь,Что делать?*\n\n",
+                    reply_markup=_AUTH_BEGIN_KEYBOARD,
+                    parse_mode="Markdown"
+                )
+            else:
+                await query.message.reply_text(
+                    "*Возникли вопросы? Я помогу тебе найти на них ответы.*\n"
+                    "*Ознакомься с моими основными командами:*\n"
+                    "1. /exit - выход из системы\n",
+                    parse_mode="Markdown"
+                )
+        else:
+            await query.message.reply_text("Неизвестная команда")
+            return
+    except Exception as e:
+        logger.error("Error in button_handler: %s", e, exc_info=True)
+        await query.message.reply_text(f"❌ Ошибка при получении данных: {e}")
 
 
-class ReplyHandler:
+# Через сколько секунд показывать заглушку "Receiving data", если данные ещё не готовы
+PLACEHOLDER_DELAY = 0.2
 
-    async def handle_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE, async_w3):
-        """Обработчик кнопки Данные"""
-        user_id = update.effective_user.id
-        get_user = await get_user_by_telegram_id(user_id)
-        registration_check = bool(get_user)
 
-        if not registration_check:
-            await update.message.reply_text(
-                "❌ Вы не зарегистрированы в системе",
-                reply_markup=inlinekeyboard.get_auth_keyboard()
-            )
-            return
+async def handle_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE, async_w3):
+    """Обработчик кнопки Данные"""
+    user_id = update.effective_user.id
+    registration_check = await is_registered(user_id)
 
-        try:
-            message = await update.message.reply_text("🔄 Receiving data, please wait...")
-            data = await process_user_data(user_id, async_w3)
-            await message.edit_text(text=data, parse_mode="Markdown")
-        except Exception as e:
-            logger.error(f"Error in handle_data_command: {e}")
-            await update.message.reply_text(f"❌ Error: {str(e)}")
+    if not registration_check:
+        await update.message.reply_text(
+            "❌ Вы не зарегистрированы в системе",
+            reply_markup=_AUTH_KEYBOARD
+        )
+        return
 
+    data_task = asyncio.create_task(process_user_data(user_id, async_w3))
+    try:
+        # Быстрые ответы отправляем сразу, без сообщения-заглушки и последующего edit
+        done, _ = await asyncio.wait({data_task}, timeout=PLACEHOLDER_DELAY)
+        if done:
+            await update.message.reply_text(data_task.result(), parse_mode="Markdown")
+            return
 
-replyhandler = ReplyHandler()
\ No newline at end of file
+        message = await update.message.reply_text("🔄 Receiving data, please wait...")
+        data = await data_task
+        await message.edit_text(text=data, parse_mode="Markdown")
+    except Exception as e:
+        logger.error("Error in handle_data_command: %s", e)
+        await update.message.reply_text(f"❌ Error: {str(e)}")
+    finally:
+        # Если отправка заглушки упала, задача ещё идёт: отменяем и дожидаемся её, чтобы она не осталась без присмотра
+        data_task.cancel()
+        await asyncio.gather(data_task, return_exceptions=True)
@@ -1,25 +1,29 @@
 #/config.py
+import functools
 import os
-from typing import List
+import re
+from typing import FrozenSet
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
 from pydantic import ConfigDict
 from pydantic import Field
 
-# Определяет, какой .env файл использовать
-env_file = ".env.production.bot" if os.getenv("ENVIRONMENT") == "production" else ".env"
-load_dotenv(env_file)
+# Разделитель списка ADMIN_IDS: запятая с любыми пробелами вокруг
+_ADMIN_IDS_SEPARATOR = re.compile(r"\s*,\s*")
 
 
 class Settings(BaseSettings):
     # PostgreSQL Database
     DATA_BASE_URL: str
     POSTGRES_PORT_RAG: str
+    # Пул соединений RAG БД (~2 x ядра сервера БД + диски, по формуле HikariCP)
+    POSTGRES_POOL_MIN_RAG: int = 10
+    POSTGRES_POOL_MAX_RAG: int = 25
 
     # Telegram
     BOT_TN: str
-    ADMIN_IDS: List[int]
+    ADMIN_IDS: FrozenSet[int]  # множество: проверка "user_id in ADMIN_IDS" за O(1)
 
     #Open AI
     OPENAI_API_KEY: str
@@ -27,24 +31,51 @@ class Settings(BaseSettings):
     AI_MODEL: str
     AI_MAX_TOKENS: int
     AI_TEMPERATURE: float
+    AI_MAX_CONCURRENCY: int = 50  # одновременных запросов к OpenAI на процесс
     COLLECT_TRAINING_DATA: bool = Field(default=False, validation_alias="COLLECT_TRAINING_DATA")
     RAG_ENABLED: bool
+    # Семантический кэш ответов (лишний запрос эмбеддинга на каждое сообщение, поэтому выключен по умолчанию)
+    SEMANTIC_CACHE_ENABLED: bool = False
+    # Файл SQLite с кэшем эмбеддингов RAG; пусто - без кэша.
+    # Каталог data/ в контейнере смонтирован как том (docker-compose.yml), иначе кэш теряется при пересоздании
+    EMBEDDING_CACHE_PATH: str = "data/embedcache.sqlite3"
+    # Сколько чанков документов уходит в API эмбеддингов одним запросом
+    RAG_BATCH_SIZE: int = 96
+    # Пересчитать эмбеддинги базы знаний при запуске, если они сохранены под другую размерность
+    RAG_REEMBED: bool = True
 
-    ADMIN_IDS: List[int]
     @field_validator("ADMIN_IDS", mode="before")
     @classmethod
     def parse_admin_ids(cls, v):
         if isinstance(v, str):
-            return [int(x.strip()) for x in v.split(",") if x.strip()]
+            return list(map(int, filter(None, _ADMIN_IDS_SEPARATOR.split(v.strip()))))
         return v
 
     WELCOME_PHOTO_ID: str
 
+    # Redis для context.user_data (история диалога); пусто - хранится только в памяти процесса
+    REDIS_URL: str = ""
+
+    # Webhook (если WEBHOOK_URL не задан, бот работает через polling)
+    WEBHOOK_URL: str = ""
+    WEBHOOK_SECRET: str = ""
+    WEBHOOK_LISTEN: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8443
+
 
     model_config = ConfigDict(
         extra="ignore",  # ← игнорировать лишние переменные (например, ENVIRONMENT)
         case_sensitive=False,
-        env_file_encoding="utf-8"
+        env_file_encoding="utf-8",
+        frozen=True,  # настройки не меняются во время работы бота
+        validate_default=False  # значения по умолчанию заданы в коде, проверять их не нужно
     )
-# Глобальный экземпляр
-settings = Settings()
\ No newline at end of file
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Читает .env и собирает настройки один раз за процесс"""
+    # Определяет, какой .env файл использовать
+    env_file = ".env.production.bot" if os.getenv("ENVIRONMENT") == "production" else ".env"
+    load_dotenv(env_file)
+    return Settings()
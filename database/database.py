@@ -1,28 +1,61 @@
 #database
 import asyncpg
 import logging
-import os
 import asyncio
-from typing import Optional, List, Tuple, Dict, Any
-from dotenv import load_dotenv
-from config import settings
+import functools
+import weakref
+from typing import Optional, List, Tuple, Any, Awaitable, Callable
+from cachetools import TTLCache
+from config import get_settings
 from database.schemas import TableName, TABLE_SCHEMAS, INDEXES
 
 logger = logging.getLogger(__name__)
-
-# --- Загрузка конфигурации ---
-load_dotenv()
+settings = get_settings()
 
 # --- Глобальный пул соединений ---
 _pool: Optional[asyncpg.Pool] = None
+_health_check_task: Optional[asyncio.Task] = None
+
+# Как часто пингуем БД, чтобы соединения (и NAT-трансляции до БД) не протухали
+HEALTH_CHECK_INTERVAL = 60
+
+# --- Горячие запросы ---
+# asyncpg готовит каждый запрос один раз на соединение и держит его в кэше выражений,
+# поэтому текст запросов вынесен в константы и должен совпадать байт в байт
+SQL_GET_USER = "SELECT * FROM user_registration WHERE telegram_id = $1"
+SQL_IN_WHITE_LIST = "SELECT EXISTS(SELECT 1 FROM user_white_list WHERE user_name = $1)"
+# Регистрация и проверка white list одним запросом: NULL значит "нет в white list" или "уже зарегистрирован"
+SQL_REGISTER_USER = """
+    WITH wl AS (SELECT 1 FROM user_white_list WHERE user_name = $2)
+    INSERT INTO user_registration (telegram_id, user_name)
+    SELECT $1, $2 WHERE EXISTS (SELECT 1 FROM wl)
+    ON CONFLICT (telegram_id) DO NOTHING
+    RETURNING telegram_id
+"""
+SQL_DELETE_USER = "DELETE FROM user_registration WHERE telegram_id = $1 RETURNING telegram_id"
+
+# --- Кэш редко меняющейся проверки регистрации ---
+_registration_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# Блокировки на ключ, чтобы параллельные промахи не шли в БД одновременно
+_cache_locks: "weakref.WeakValueDictionary[Any, asyncio.Lock]" = weakref.WeakValueDictionary()
+# Растёт при каждом сбросе ключа: загрузка, начатая до сброса, не кладёт в кэш устаревшее значение
+_cache_generation = 0
 
 
 async def init_db():
     """Инициализирует пул соединений с PostgreSQL"""
-    global _pool
+    global _pool, _health_check_task
     try:
         if _pool is None:
-            _pool = await asyncpg.create_pool(settings.DATA_BASE_URL, min_size=2, max_size=20)
+            _pool = await asyncpg.create_pool(
+                settings.DATA_BASE_URL,
+                min_size=4,
+                max_size=32,
+                command_timeout=5.0,  # зависшее соединение не должно блокировать обработчик навсегда
+                statement_cache_size=1024,
+                max_inactive_connection_lifetime=300,
+                server_settings={"application_name": "voltic_bot", "jit": "off"}
+            )
             logger.info("✅ PostgreSQL connection pool initialized")
 
             # Проверяем подключение
@@ -32,6 +65,8 @@ async def init_db():
             # Создаем все таблицы
             await create_tables()
 
+            _health_check_task = asyncio.create_task(_health_check_loop())
+
             logger.info("✅ Database initialization completed successfully")
 
     except Exception as e:
@@ -42,16 +77,19 @@ async def init_db():
 
 async def create_tables():
     """Создает все таблицы из схемы"""
-    async with _pool.acquire() as conn:
-        for table_name, schema in TABLE_SCHEMAS.items():
-            await conn.execute(schema)
-            logger.info(f"✅ Table '{table_name.value}' created/verified")
+    # Таблицы и их индексы собираем в один скрипт: без параметров asyncpg отправляет его
+    # одним simple query, то есть за один round trip вместо запроса на каждый оператор
+    statements = []
+    for table_name, schema in TABLE_SCHEMAS.items():
+        statements.append(schema.strip())
+        statements.extend(INDEXES.get(table_name, []))
+    script = ";\n".join(statements) + ";"
 
-            # Создаем индексы для таблицы
-            for index_sql in INDEXES.get(table_name, []):
-                await conn.execute(index_sql)
+    async with _pool.acquire() as conn:
+        await conn.execute(script)
 
-        logger.info("✅ All database tables and indexes created/verified")
+    logger.info("✅ Tables created/verified: %s", ", ".join(t.value for t in TABLE_SCHEMAS))
+    logger.info("✅ All database tables and indexes created/verified")
 
 # =====================================================================================
 async def get_pool() -> asyncpg.Pool:
@@ -62,9 +100,22 @@ async def get_pool() -> asyncpg.Pool:
     return _pool
 
 
+async def _health_check_loop():
+    """Периодически выполняет SELECT 1 через пул"""
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        try:
+            await _pool.fetchval("SELECT 1")
+        except Exception as e:
+            logger.warning(f"⚠️ PostgreSQL health check failed: {e}")
+
+
 async def close_db():
     """Закрывает пул соединений"""
-    global _pool
+    global _pool, _health_check_task
+    if _health_check_task:
+        _health_check_task.cancel()
+        _health_check_task = None
     if _pool:
         await _pool.close()
         _pool = None
@@ -80,6 +131,35 @@ def with_connection(func):
     return wrapper
 
 
+async def _cached(cache: TTLCache, key: Any, loader: Callable[[], Awaitable[Any]]) -> Any:
+    """Возвращает значение из кэша, при промахе загружает его один раз под блокировкой ключа"""
+    if key in cache:
+        return cache[key]
+
+    lock_key = (id(cache), key)
+    lock = _cache_locks.get(lock_key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _cache_locks[lock_key] = lock
+
+    async with lock:
+        if key in cache:
+            return cache[key]
+        generation = _cache_generation
+        value = await loader()
+        if generation == _cache_generation:
+            cache[key] = value
+        return value
+
+
+def _invalidate(cache: TTLCache, key: Any):
+    """Сбрасывает ключ после изменения в БД (в том числе для загрузок, которые ещё идут)"""
+    global _cache_generation
+    _cache_generation += 1
+    cache.pop(key, None)
+
+
+@functools.lru_cache(maxsize=4096)
 def normalize_username(username: Optional[str]) -> str:
     """
     Нормализует username:
@@ -89,6 +169,10 @@ def normalize_username(username: Optional[str]) -> str:
     if not username:
         return ""
 
+    # Частый случай: username уже нормализован
+    if username[0] != '@' and username.islower() and not username[0].isspace() and not username[-1].isspace():
+        return username
+
     if username.startswith('@'):
         username = username[1:]
 
@@ -97,54 +181,52 @@ def normalize_username(username: Optional[str]) -> str:
 # ============================== USER_REGISTRATION ==================================
 
 @with_connection
-async def get_user_by_telegram_id(conn: asyncpg.Connection, telegram_id: int):
-    """Проверяет, есть ли пользователь в user_registration"""
-    return await conn.fetchrow("SELECT * FROM user_registration WHERE telegram_id = $1", telegram_id)
+async def _fetch_user_by_telegram_id(conn: asyncpg.Connection, telegram_id: int):
+    return await conn.fetchrow(SQL_GET_USER, telegram_id)
+
+
+async def get_user_by_telegram_id(telegram_id: int):
+    """Проверяет, есть ли пользователь в user_registration (с кэшем на 60 секунд)"""
+    return await _cached(_registration_cache, telegram_id, lambda: _fetch_user_by_telegram_id(telegram_id))
+
+
+async def is_registered(telegram_id: int) -> bool:
+    """Зарегистрирован ли пользователь (тот же кэш, что и у get_user_by_telegram_id)"""
+    return await get_user_by_telegram_id(telegram_id) is not None
 
 @with_connection
 async def register_user(conn, user_id: int, username: str) -> Tuple[bool, str]:
     """
-    Регистрации с транзакцией
+    Регистрация одним запросом (проверка white list + вставка)
     """
     normalized_username = normalize_username(username)
 
     if not normalized_username:
         return False, "❌ Установите username в Telegram"
 
-    async with conn.transaction():
-        try:
-            # 1. Проверка white list в транзакции
-            in_white_list = await conn.fetchval(
-                "SELECT COUNT(*) > 0 FROM user_white_list WHERE user_name = $1",
-                normalized_username
-            )
+    try:
+        registered_id = await conn.fetchval(SQL_REGISTER_USER, user_id, normalized_username)
 
+        if registered_id is None:
+            # Вставка не прошла: уточняем причину только в этом (редком) случае
+            in_white_list = await conn.fetchval(SQL_IN_WHITE_LIST, normalized_username)
             if not in_white_list:
                 return False, "❌ У вас нет доступа к боту.\nОбратитесь к администратору для добавления в white list."
+            return False, "Вы уже зарегистрированы!"
 
-            # 2. Попытка регистрации с обработкой конфликта
-            try:
-                await conn.execute(
-                    "INSERT INTO user_registration (telegram_id, user_name) VALUES ($1, $2)",
-                    user_id, normalized_username
-                )
-                return True, "✅ Вы успешно зарегистрированы! Теперь давай начнем работу! Задавай мне вопросы и я обязательно отвечу на них!"
+    except asyncpg.UniqueViolationError:
+        # telegram_id разобран в ON CONFLICT, сюда попадает только занятый другим аккаунтом user_name
+        return False, "❌ Этот username уже занят другим пользователем.\nОбратитесь к администратору."
 
-            except asyncpg.UniqueViolationError:
-                # telegram_id уже существует
-                return False, "Вы уже зарегистрированы!"
+    except Exception as e:
+        logger.error(f"Ошибка регистрации для пользователя {user_id}: {e}")
+        return False, "❌ Произошла внутренняя ошибка."
 
-        except Exception as e:
-            logger.error(f"Ошибка регистрации для пользователя {user_id}: {e}")
-            return False, "❌ Произошла внутренняя ошибка."
+    _invalidate(_registration_cache, user_id)
+    return True, "✅ Вы успешно зарегистрированы! Теперь давай начнем работу! Задавай мне вопросы и я обязательно отвечу на них!"
 
 # ========================== WHITE LIST =========================================
 
-@with_connection
-async def check_white_list(conn: asyncpg.Connection, username: str) -> bool:
-    """Проверяет, есть ли пользователь в white list"""
-    return await conn.fetchrow("SELECT COUNT(*) FROM user_white_list WHERE user_name = $1",  username)
-
 @with_connection
 async def get_white_list_users(conn) -> List[str]:
     """Получить список всех username в white list"""
@@ -154,46 +236,72 @@ async def get_white_list_users(conn) -> List[str]:
 
     return [f"@{row['user_name']}" for row in rows]
 
-@with_connection
-async def add_to_white_list(conn, username: str) -> Tuple[bool, str]:
-    """Добавить username в white list"""
-    normalized_username = normalize_username(username)
 
-    if not normalized_username:
-        return False, "❌ Неверный username"
+# Длина колонки user_name в обеих таблицах (VARCHAR(25))
+USERNAME_MAX_LENGTH = 25
+
+
+def _split_usernames(usernames: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """Нормализует список username: (корректные без повторов, [(username, ошибка)])"""
+    valid = []
+    invalid = []
+    for username in usernames:
+        normalized_username = normalize_username(username)
+        if not normalized_username or len(normalized_username) > USERNAME_MAX_LENGTH:
+            invalid.append((username, "❌ Неверный username"))
+        elif normalized_username not in valid:
+            valid.append(normalized_username)
+    return valid, invalid
+
+
+@with_connection
+async def add_to_white_list_bulk(conn, usernames: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Добавляет несколько username в white list одним запросом
+    Returns:
+        (добавленные username, [(username, причина ошибки)])
+    """
+    valid, failed = _split_usernames(usernames)
+    if not valid:
+        return [], failed
 
     try:
         await conn.execute("""
             INSERT INTO user_white_list (user_name)
-            VALUES ($1)
+            SELECT unnest($1::varchar[])
             ON CONFLICT (user_name) DO NOTHING
-        """, normalized_username)
-
-        return True, f"✅ @{normalized_username} добавлен в white list"
-
+        """, valid)
     except Exception as e:
         logger.error(f"❌ Ошибка при добавлении в white list: {e}")
-        return False, f"❌ Ошибка: {e}"
+        return [], failed + [(username, f"❌ Ошибка: {e}") for username in valid]
 
-@with_connection
-async def remove_from_white_list(conn, username: str) -> Tuple[bool, str]:
-    """Удалить username из white list"""
-    normalized_username = normalize_username(username)
+    return valid, failed
 
-    try:
-        result = await conn.execute("""
-            DELETE FROM user_white_list WHERE user_name = $1
-        """, normalized_username)
 
-        if result == "DELETE 1":
-            logger.info(f"✅ @{normalized_username} удален из white list")
-            return True, f"✅ @{normalized_username} удален из white list"
-        else:
-            return False, "❌ Username не найден в white list"
+@with_connection
+async def remove_from_white_list_bulk(conn, usernames: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Удаляет несколько username из white list одним запросом
+    Returns:
+        (удалённые username, [(username, причина ошибки)])
+    """
+    valid, failed = _split_usernames(usernames)
+    if not valid:
+        return [], failed
 
+    try:
+        rows = await conn.fetch("""
+            DELETE FROM user_white_list WHERE user_name = ANY($1::varchar[])
+            RETURNING user_name
+        """, valid)
     except Exception as e:
         logger.error(f"❌ Ошибка при удалении из white list: {e}")
-        return False, f"❌ Ошибка: {e}"
+        return [], failed + [(username, f"❌ Ошибка: {e}") for username in valid]
+
+    deleted = {row['user_name'] for row in rows}
+    removed = [username for username in valid if username in deleted]
+    failed += [(username, "❌ Username не найден в white list") for username in valid if username not in deleted]
+    return removed, failed
 
 # ================================================================================
 
@@ -201,73 +309,24 @@ async def remove_from_white_list(conn, username: str) -> Tuple[bool, str]:
 async def delete_user(
         conn: asyncpg.Connection,
         telegram_id: int
-) -> Dict[str, Any]:
+) -> bool:
     """
     Удаляет пользователя из базы данных
 
     Args:
         telegram_id: ID пользователя в Telegram
     Returns:
-        Словарь с результатом операции
+        True - пользователь удалён, False - такого пользователя не было.
+        Ошибки БД пробрасываются вызывающему.
     """
-    try:
-        # Сначала проверяем, существует ли пользователь
-        user_exists = await conn.fetchval(
-            "SELECT EXISTS(SELECT 1 FROM user_registration WHERE telegram_id = $1)",
-            telegram_id
-        )
-
-        if not user_exists:
-            logger.warning(f"⚠️ User {telegram_id} not found for deletion")
-            return {
-                "success": False,
-                "message": "User not found",
-                "deleted": False,
-                "telegram_id": telegram_id
-            }
-
-        # Удаляем пользователя
-        result = await conn.execute(
-            "DELETE FROM user_registration WHERE telegram_id = $1",
-            telegram_id
-        )
-
-        # Проверяем, была ли удалена хотя бы одна строка
-        deleted_count = int(result.split()[1])  # Пример: "DELETE 1"
-
-        if deleted_count > 0:
-            logger.info(f"🗑️ User {telegram_id} successfully deleted")
-            return {
-                "success": True,
-                "message": "User deleted successfully",
-                "deleted": True,
-                "telegram_id": telegram_id,
-                "deleted_count": deleted_count
-            }
-        else:
-            logger.warning(f"⚠️ No user deleted for telegram_id {telegram_id}")
-            return {
-                "success": False,
-                "message": "No user was deleted",
-                "deleted": False,
-                "telegram_id": telegram_id
-            }
-
-    except asyncpg.ForeignKeyViolationError as e:
-        logger.error(f"❌ Cannot delete user {telegram_id}: foreign key constraint violation")
-        return {
-            "success": False,
-            "message": "Cannot delete user: user has related data. Use cascade=True or delete related data first.",
-            "deleted": False,
-            "telegram_id": telegram_id,
-            "error": str(e)
-        }
-    except Exception as e:
-        logger.error(f"❌ Error deleting user {telegram_id}: {e}")
-        return {
-            "success": False,
-            "message": f"Database error: {str(e)}",
-            "deleted": False,
-            "telegram_id": telegram_id,
-            "error": str(e)
-        }
\ No newline at end of file
+    # RETURNING сразу говорит, была ли такая строка (NULL - не найден)
+    deleted_id = await conn.fetchval(SQL_DELETE_USER, telegram_id)
+
+    _invalidate(_registration_cache, telegram_id)
+
+    if deleted_id is None:
+        logger.warning(f"⚠️ User {telegram_id} not found for deletion")
+        return False
+
+    logger.info(f"🗑️ User {telegram_id} successfully deleted")
+    return True
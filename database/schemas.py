@@ -23,12 +23,12 @@ TABLE_SCHEMAS = {
     """
 }
 
+# Отдельные индексы по user_name не нужны: UNIQUE уже создаёт btree-индекс в обеих таблицах.
+# Старый idx_user_name (имя было общим для двух таблиц) удаляем в уже развёрнутых базах.
 INDEXES = {
     TableName.USER_REGISTRATION: [
         "CREATE INDEX IF NOT EXISTS idx_user_registered_at ON user_registration(registered_at)",
-        "CREATE INDEX IF NOT EXISTS idx_user_name ON user_registration(user_name)"
+        "DROP INDEX IF EXISTS idx_user_name"
     ],
-    TableName.USER_WHITE_LIST: [
-        "CREATE INDEX IF NOT EXISTS idx_user_name ON user_white_list(user_name)"
-    ]
+    TableName.USER_WHITE_LIST: []
 }
\ No newline at end of file
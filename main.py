@@ -1,10 +1,33 @@
 import os
 import json
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
+from contextlib import AsyncExitStack
+from io import BytesIO
+
+# --- Настройка логирования (до импорта модулей бота, они пишут в лог при импорте) ---
+# Обработчики пишут записи в очередь, а вывод в поток/файл делает отдельный поток QueueListener
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output, respect_handler_level=True)
+_log_input = logging.handlers.QueueHandler(_log_queue)
+_log_input.setFormatter(logging.Formatter("%(message)s"))  # окончательный формат задаёт _log_output
+logging.basicConfig(
+    handlers=[_log_input],
+    level=logging.INFO,
+    force=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, \
     ReplyKeyboardRemove
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -14,27 +37,26 @@ from telegram.ext import (
     ConversationHandler
 )
 
-from button_handlers import inlinehandler
+from button_handlers import handler_begin_registration
 from database.database import (
-    init_db, close_db, get_user_by_telegram_id, add_to_white_list, delete_user, get_white_list_users,
-    remove_from_white_list
+    init_db, close_db, is_registered, add_to_white_list_bulk, delete_user, get_white_list_users,
+    remove_from_white_list_bulk
 )
-from config import settings
+from config import get_settings
 from telegram.constants import ParseMode
-from ai_service import ai_assistant
+from telegram.request import HTTPXRequest
+from ai_service import ai_assistant, AI_ERROR_MESSAGES
+from semantic_cache import SemanticCache
+from redis_persistence import RedisPersistence
+from background import fire, drain
 from datetime import datetime
 from keyboard.keyboard import inlinekeyboard
 # Импортируем RAG компоненты
-from rag_system.rag_system import init_rag_system, get_rag_components, close_rag_system
+from rag_system.rag_system import RagDisabled, RagInitError, rag_system
 
 
-# --- Настройка логирования ---
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    force=True
-)
 logger = logging.getLogger(__name__)
+settings = get_settings()
 
 # ================================================================
 
@@ -51,21 +73,47 @@ ADMIN_IDS = settings.ADMIN_IDS
 # ID картинки приветствия
 WELCOME_PHOTO_ID = settings.WELCOME_PHOTO_ID
 
+# Telegram показывает статус "печатает" около 5 секунд, обновляем его чуть чаще
+TYPING_INTERVAL = 4
+
+# Ключ в application.bot_data, под которым лежит RagContext (нет ключа - RAG не работает)
+RAG_KEY = 'rag'
+
+# Путь webhook: секрет в пути, чтобы адрес нельзя было угадать
+WEBHOOK_PATH = f"webhook/{settings.WEBHOOK_SECRET}" if settings.WEBHOOK_SECRET else "webhook"
+
+# ================================================================
+
+# Клавиатура для незарегистрированных пользователей не меняется, собираем её один раз
+AUTH_KB = inlinekeyboard.get_auth_keyboard()
+
+# Расширения документов, которые принимает загрузка в RAG
+SUPPORTED_EXTS = frozenset(('pdf', 'txt', 'md', 'text', 'docx'))
+# Документы одного альбома приходят отдельными сообщениями; ждём остальные столько секунд и грузим пачкой
+MEDIA_GROUP_DELAY = 1.5
+# media_group_id -> сообщения альбома, ещё не отданные в загрузку
+_media_groups: dict = {}
+
+# ================================================================
+
+# Семантический кэш ответов ИИ (None - выключен)
+semantic_cache = SemanticCache() if settings.SEMANTIC_CACHE_ENABLED else None
+
 # ==================== Обработчики команд и кнопок ===============================
 # ==================== Команда /start ============================================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} запустил /start")
-    registration_check = await get_user_by_telegram_id(user_id)
+    logger.info("Пользователь %s запустил /start", user_id)
+    registration_check = await is_registered(user_id)
     if not registration_check:
-        logger.info(f"Пользователь {user_id} не зарегистрирован")
+        logger.info("Пользователь %s не зарегистрирован", user_id)
         # Очищаем состояние
         context.user_data.clear()
         await update.message.reply_photo(
             photo=WELCOME_PHOTO_ID,
             caption="👋 Добро пожаловать, я твой помощник в мире энергетики, задавай мне вопросы и я обязательно помогу тебе!",
-            reply_markup = inlinekeyboard.get_auth_keyboard()
+            reply_markup = AUTH_KB
         )
     else:
         await update.message.reply_text(
@@ -76,31 +124,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /exit"""
     user_id = update.effective_user.id
-    registration_check = await get_user_by_telegram_id(user_id)
-    if not registration_check:
-        await update.message.reply_text(
-            "❌ You are not logged in.",
-            reply_markup=inlinekeyboard.get_auth_keyboard()
-        )
-        return
 
     try:
-        success = await delete_user(user_id)
-        if success:
+        # Удаление само говорит, был ли пользователь зарегистрирован: отдельная проверка не нужна
+        deleted = await delete_user(user_id)
+        if not deleted:
+            await update.message.reply_text(
+                "❌ You are not logged in.",
+                reply_markup=AUTH_KB
+            )
+        else:
             # ОЧИЩАЕМ AI-ИСТОРИЮ ПРИ ВЫХОДЕ
-            if 'ai_history' in context.user_data:
-                del context.user_data['ai_history']
+            context.user_data.pop('ai_history', None)
+            context.user_data.pop('ai_summary', None)
 
             await update.message.reply_text(
                 "✅ Ваши данные успешно удалены из системы.\n\n"
                 "🔁 Для повторной регистрации, обратитесь к администратору.\n\n",
-                reply_markup=inlinekeyboard.get_auth_keyboard()
+                reply_markup=AUTH_KB
             )
-        else:
-            await update.message.reply_text("❌ Error during logout. Please try again later.")
     except Exception as e:
-        logger.error(f"Error in handle_logout_command: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
+        logger.error("Error in handle_logout_command: %s", e)
+        await update.message.reply_text("❌ Error during logout. Please try again later.")
 
 
 # 6 ================= Обработчик текстовых сообщений ===============================
@@ -108,24 +153,19 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
-    registration_check = await get_user_by_telegram_id(user_id)
+    registration_check = await is_registered(user_id)
 
     if not registration_check:
         await update.message.reply_text(
             "❌ Вы не зарегистрированы в системе",
-            reply_markup=inlinekeyboard.get_auth_keyboard()
+            reply_markup=AUTH_KB
         )
         return
 
-    # 2. Проверяем состояние ожидания RAG документа
-    if context.user_data.get('awaiting_rag_document'):
-        await handle_document_upload(update, context)
-        return
-
     # Проверяем, что будет обрабатывать сообщение
     # Если пользователь авторизован в боте и AI включено в .env: используем AI
     if settings.AI_ENABLED:
-        logger.info(f"Ответ от AI")
+        logger.info("Ответ от AI")
         await handle_ai_message(update, context, text)
         return
     # Иначе используем обработчик неизвестных команд:
@@ -138,68 +178,140 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Обработчик AI-сообщений"""
     user_id = update.effective_user.id
-    logger.info(f"User {user_id} asked AI: {text[:50]}...")
+    logger.info("User %s asked AI: %.50s...", user_id, text)
 
     # Получаем историю диалога из context.user_data
     if 'ai_history' not in context.user_data:
         context.user_data['ai_history'] = []
 
     history = context.user_data['ai_history']
+    summary = context.user_data.get('ai_summary')
 
-
+    # Пока ждём очередь и ответ модели, пользователь видит "печатает..."
+    typing_task = asyncio.create_task(keep_typing(update.message.chat))
     try:
-        await update.message.chat.send_action(action="typing")
-
         # Проверяем RAG перед обычным AI
         ai_response = None
+        from_cache = False
+        query_embedding = None
+
+        # Сначала ищем ответ на похожий вопрос в семантическом кэше
+        if semantic_cache is not None:
+            query_embedding = await ai_assistant.embed(text)
+            hit = semantic_cache.lookup(user_id, query_embedding) if query_embedding is not None else None
+            if hit:
+                ai_response = hit.response
+                from_cache = True
+                logger.info("Semantic cache hit for user %s, similarity %.3f", user_id, hit.similarity)
 
         # Если RAG включен и пользователь админ или обычный пользователь (в зависимости от настроек)
-        if settings.RAG_ENABLED:
+        rag = context.bot_data.get(RAG_KEY)
+        if not ai_response and rag is not None:
             try:
-                from rag_system import rag_engine
-                if rag_engine:
-                    # Пробуем использовать RAG
-                    rag_result = await rag_engine.process_query(text, user_id, history)
-
-                    if rag_result['success'] and rag_result['rag_used']:
-                        ai_response = rag_result['response']
-                        logger.info(f"RAG used for user {user_id}, chunks: {rag_result['chunks_used']}")
-                    else:
-                        # RAG не сработал или не нашел релевантной информации
-                        logger.info(f"RAG fallback for user {user_id}, using regular AI")
+                # Пробуем использовать RAG
+                rag_result = await rag.engine.process_query(
+                    text, user_id, history, query_embedding=query_embedding, summary=summary
+                )
+
+                if rag_result and rag_result['success'] and rag_result['rag_used']:
+                    ai_response = rag_result['response']
+                    logger.info("RAG used for user %s, chunks: %s", user_id, rag_result['chunks_used'])
+                else:
+                    # RAG не сработал или не нашел релевантной информации
+                    logger.info("RAG fallback for user %s, using regular AI", user_id)
             except Exception as rag_error:
-                logger.error(f"RAG processing error: {rag_error}")
+                logger.error("RAG processing error: %s", rag_error)
 
-        # Если RAG не дал ответа или отключен, используем обычный AI
+        # Если RAG не дал ответа или отключен, используем обычный AI и показываем ответ по мере генерации
+        streamed = False
         if not ai_response:
-            logger.info(f"RAG пропущен")
-            ai_response = await ai_assistant.get_response(
-                user_message=text,
-                user_id=user_id,
-                history=history,
-                RAG=False
-            )
+            logger.info("RAG пропущен")
+            ai_response = await reply_streaming(update, user_id, text, history, summary)
+            streamed = True
+
+        if query_embedding is not None and not from_cache and ai_response not in AI_ERROR_MESSAGES:
+            semantic_cache.put(user_id, query_embedding, ai_response)
 
         # Сохраняем в историю (для контекста в будущем)
         history.append({"role": "user", "content": text})
         history.append({"role": "assistant", "content": ai_response})
 
-        # Ограничиваем длину истории (последние 3 пары вопрос-ответ)
+        # Дословно храним последние 3 пары вопрос-ответ, более старые сообщения сжимаем в резюме в фоне
         max_history_pairs = 3
         if len(history) > max_history_pairs * 2:
+            older = history[:-max_history_pairs * 2]
             context.user_data['ai_history'] = history[-max_history_pairs * 2:]
+            fire(update_summary(context.user_data, older))
         else:
             context.user_data['ai_history'] = history
 
-        # Отправляем ответ пользователю
-        await update.message.reply_text(ai_response)
+        # Отправляем ответ пользователю (потоковый ответ уже отправлен)
+        if not streamed:
+            await update.message.reply_text(ai_response)
 
     except Exception as e:
-        logger.error(f"AI processing error for user {user_id}: {e}")
+        logger.error("AI processing error for user %s: %s", user_id, e)
         await update.message.reply_text(
             "🤖 Sorry, there was a technical error. "
             "Please use the menu buttons or try again later."
         )
+    finally:
+        typing_task.cancel()
+
+
+async def keep_typing(chat):
+    """Отправляет статус "печатает" каждые TYPING_INTERVAL секунд, пока задачу не отменят"""
+    while True:
+        try:
+            await chat.send_action(action="typing")
+        except Exception as e:
+            logger.warning("send_action failed: %s", e)
+        await asyncio.sleep(TYPING_INTERVAL)
+
+
+async def update_summary(user_data: dict, older: list):
+    """Добавляет вытесненные из истории сообщения в резюме диалога пользователя"""
+    summary = await ai_assistant.summarize(older, user_data.get('ai_summary'))
+    if summary:
+        user_data['ai_summary'] = summary
+
+
+# Не чаще одного редактирования сообщения за этот интервал (лимиты Telegram на edit)
+STREAM_EDIT_INTERVAL = 0.5
+
+
+async def reply_streaming(update: Update, user_id: int, text: str, history: list, summary: str = None) -> str:
+    """Отправляет ответ ИИ по мере генерации, редактируя одно сообщение; возвращает полный текст"""
+    loop = asyncio.get_running_loop()
+    parts = []
+    message = None
+    sent_text = ""
+    last_edit = 0.0
+
+    async for delta in ai_assistant.stream_response(
+            user_message=text, user_id=user_id, history=history, summary=summary
+    ):
+        parts.append(delta)
+        now = loop.time()
+        if now - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+
+        partial = "".join(parts).replace("```", "").strip()
+        if not partial or partial == sent_text:
+            continue
+        if message is None:
+            message = await update.message.reply_text(partial)
+        else:
+            await message.edit_text(partial)
+        sent_text = partial
+        last_edit = now
+
+    ai_response = "".join(parts).replace("```", "").strip()
+    if message is None:
+        await update.message.reply_text(ai_response)
+    elif ai_response != sent_text:
+        await message.edit_text(ai_response)
+    return ai_response
 
 # ========================= Обработчик неизвестных команд ======================
 
@@ -238,32 +350,22 @@ async def add_to_wl_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Обработка каждого username
-    added_users = []
-    failed_users = []
+    # Проверяем формат заранее, корректные username добавляем одним запросом
+    usernames = [arg.strip() for arg in context.args]
+    valid = [username for username in usernames if username.startswith('@')]
+    failed_users = [
+        f"{username}: неверный формат, username должен начинаться с @"
+        for username in usernames if not username.startswith('@')
+    ]
 
-    for username_arg in context.args:
-        # Очищаем username от возможных символов
-        username = username_arg.strip()
+    added, failed = await add_to_white_list_bulk(valid) if valid else ([], [])
+    added_users = [f"@{username}" for username in added]
+    failed_users += [f"{username}: {message}" for username, message in failed]
 
-        # Проверяем формат username
-        if not username.startswith('@'):
-            await update.message.reply_text(
-                f"❌ Неверный формат: `{username}`\n"
-                "Username должен начинаться с @ (например: @username)",
-                parse_mode="Markdown"
-            )
-            continue
-
-        # Добавляем в white list
-        success, message = await add_to_white_list(username)
-
-        if success:
-            added_users.append(username)
-            logger.info(f"✅ {username} добавлен в white list")
-        else:
-            failed_users.append(f"{username}: {message}")
-            logger.warning(f"❌ Ошибка добавления {username}: {message}")
+    if added_users:
+        logger.info("✅ Добавлены в white list: %s", ", ".join(added_users))
+    if failed:
+        logger.warning("❌ Ошибка добавления в white list: %s", failed)
 
     # Формируем ответ
     response_parts = []
@@ -305,27 +407,21 @@ async def remove_from_wl_command(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
-    removed_users = []
-    failed_users = []
+    usernames = [arg.strip() for arg in context.args]
+    valid = [username for username in usernames if username.startswith('@')]
+    failed_users = [
+        f"{username}: неверный формат, username должен начинаться с @"
+        for username in usernames if not username.startswith('@')
+    ]
 
-    for username_arg in context.args:
-        username = username_arg.strip()
+    removed, failed = await remove_from_white_list_bulk(valid) if valid else ([], [])
+    removed_users = [f"@{username}" for username in removed]
+    failed_users += [f"{username}: {message}" for username, message in failed]
 
-        if not username.startswith('@'):
-            await update.message.reply_text(
-                f"❌ Неверный формат: `{username}`",
-                parse_mode="Markdown"
-            )
-            continue
-
-        success, message = await remove_from_white_list(username)
-
-        if success:
-            removed_users.append(username)
-            logger.info(f"✅ Админ {user_id} удалил из white list: {username}")
-        else:
-            failed_users.append(f"{username}: {message}")
-            logger.warning(f"❌ Админ {user_id} не смог удалить {username}: {message}")
+    if removed_users:
+        logger.info("✅ Админ %s удалил из white list: %s", user_id, ", ".join(removed_users))
+    if failed:
+        logger.warning("❌ Админ %s не смог удалить: %s", user_id, failed)
 
     response_parts = []
 
@@ -365,9 +461,7 @@ async def show_wl_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Форматируем вывод
-        user_list = []
-        for i, username in enumerate(users, 1):
-            user_list.append(f"{i}. {username}")
+        user_list = [f"{i}. {username}" for i, username in enumerate(users, 1)]
 
         response = (
                 f"📋 **White list пользователей** ({len(users)}):\n\n" +
@@ -387,10 +481,10 @@ async def show_wl_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(response, parse_mode="Markdown")
 
-        logger.info(f"✅ Админ {user_id} просмотрел white list ({len(users)} пользователей)")
+        logger.info("✅ Админ %s просмотрел white list (%s пользователей)", user_id, len(users))
 
     except Exception as e:
-        logger.error(f"❌ Ошибка при показе white list: {e}")
+        logger.error("❌ Ошибка при показе white list: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при получении списка.")
 
 # ============================ Команда: /wl_help  ==================================
@@ -439,36 +533,39 @@ async def handle_document_upload(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("⛔ Загрузка документов доступна только администраторам.")
         return
 
-    # Получаем компоненты RAG
-    rag_components = get_rag_components()
-    uploader = rag_components.get('document_uploader')
-
-    if not uploader:
-        await update.message.reply_text("❌ RAG система не инициализирована.")
-        return
+    # Обработчик зарегистрирован только при работающем RAG
+    uploader = context.bot_data[RAG_KEY].uploader
 
     document = update.message.document
     filename = document.file_name or "unknown"
 
     # Проверяем формат файла
-    ext = filename.lower().split('.')[-1] if '.' in filename else ''
-    if ext not in ['pdf', 'txt', 'md', 'text', 'docx']:
+    ext = filename.rpartition('.')[2].lower() if '.' in filename else ''
+    if ext not in SUPPORTED_EXTS:
         await update.message.reply_text(
             f"⚠️ Неподдерживаемый формат: .{ext}\n"
             "Поддерживаются: PDF, TXT, MD"
         )
         return
 
+    # Несколько файлов, отправленных альбомом, загружаются одной пачкой: эмбеддинги запрашиваются общими запросами
+    group_id = update.message.media_group_id
+    if group_id:
+        group = _media_groups.get(group_id)
+        if group is None:
+            _media_groups[group_id] = group = []
+            fire(upload_media_group(group_id, context))
+        group.append(update.message)
+        return
+
     # Отправляем сообщение о начале обработки
     status_msg = await update.message.reply_text(f"⏳ Обрабатываю файл: {filename}...")
 
     try:
-        # Скачиваем файл
-        file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
+        buffer = await download_document(context, document)
 
         # Обрабатываем файл через загрузчик
-        result = await uploader.process_file(bytes(file_bytes), filename, user_id)
+        result = await uploader.process_file(buffer, filename, user_id)
 
         if result['success']:
             await status_msg.edit_text(
@@ -477,12 +574,47 @@ async def handle_document_upload(update: Update, context: ContextTypes.DEFAULT_T
                 f"📊 Создано чанков: {result['chunks_created']}\n"
                 f"📝 Длина текста: {result['total_text_length']} символов"
             )
-            logger.info(f"Админ {user_id} загрузил документ: {filename}")
+            logger.info("Админ %s загрузил документ: %s", user_id, filename)
         else:
             await status_msg.edit_text(f"❌ Ошибка: {result['error']}")
 
     except Exception as e:
-        logger.error(f"Ошибка загрузки документа: {e}")
+        logger.error("Ошибка загрузки документа: %s", e)
+        await status_msg.edit_text(f"❌ Ошибка обработки: {str(e)}")
+
+
+async def download_document(context: ContextTypes.DEFAULT_TYPE, document) -> BytesIO:
+    """Скачивает документ сразу в BytesIO: загрузчик читает этот буфер без промежуточных копий"""
+    file = await context.bot.get_file(document.file_id)
+    buffer = BytesIO()
+    await file.download_to_memory(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+async def upload_media_group(group_id: str, context: ContextTypes.DEFAULT_TYPE):
+    """Ждёт остальные документы альбома и загружает их через upload_many, итог - одним сообщением"""
+    await asyncio.sleep(MEDIA_GROUP_DELAY)
+    messages = _media_groups.pop(group_id)
+    user_id = messages[0].from_user.id
+    uploader = context.bot_data[RAG_KEY].uploader
+    filenames = [message.document.file_name or "unknown" for message in messages]
+
+    status_msg = await messages[0].reply_text(f"⏳ Обрабатываю файлы: {len(messages)}...")
+    try:
+        buffers = await asyncio.gather(*(download_document(context, message.document) for message in messages))
+        results = await uploader.upload_many(zip(buffers, filenames), user_id)
+
+        lines = [
+            f"✅ {filename}: {result['chunks_created']} чанков" if result['success']
+            else f"❌ {filename}: {result['error']}"
+            for filename, result in zip(filenames, results)
+        ]
+        await status_msg.edit_text("📄 Загрузка документов:\n\n" + "\n".join(lines))
+        logger.info("Админ %s загрузил альбом документов: %s", user_id, ", ".join(filenames))
+
+    except Exception as e:
+        logger.error("Ошибка загрузки альбома документов: %s", e)
         await status_msg.edit_text(f"❌ Ошибка обработки: {str(e)}")
 
 
@@ -497,12 +629,8 @@ async def handle_rag_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Команда доступна только администраторам.")
         return
 
-    rag_components = get_rag_components()
-    engine = rag_components.get('rag_engine')
-
-    if not engine:
-        await update.message.reply_text("❌ RAG система не инициализирована.")
-        return
+    # Обработчик зарегистрирован только при работающем RAG
+    engine = context.bot_data[RAG_KEY].engine
 
     try:
         stats = await engine.get_stats()
@@ -519,7 +647,7 @@ async def handle_rag_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
     except Exception as e:
-        logger.error(f"Ошибка получения статистики RAG: {e}")
+        logger.error("Ошибка получения статистики RAG: %s", e)
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
@@ -534,12 +662,8 @@ async def handle_rag_docs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Команда доступна только администраторам.")
         return
 
-    rag_components = get_rag_components()
-    uploader = rag_components.get('document_uploader')
-
-    if not uploader:
-        await update.message.reply_text("❌ RAG система не инициализирована.")
-        return
+    # Обработчик зарегистрирован только при работающем RAG
+    uploader = context.bot_data[RAG_KEY].uploader
 
     try:
         docs = await uploader.get_documents_list()
@@ -548,21 +672,20 @@ async def handle_rag_docs(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("📂 База знаний пуста. Загрузите документы.")
             return
 
-        text = "📚 Загруженные документы:\n\n"
-        for doc in docs:
-            filename = doc['filename'].replace('<', '').replace('>', '')
-            text += (
-                f"📄 ID: {doc['id']} | {filename}\n"
-                f"   Чанков: {doc['total_chunks']} | "
-                f"Дата: {doc['created_at'].strftime('%d.%m.%Y')}\n\n"
-            )
-
-        text += "💡 Для удаления: /rag_delete ID"
+        parts = ["📚 Загруженные документы:\n"]
+        parts.extend(
+            f"📄 ID: {doc['id']} | {doc['filename'].replace('<', '').replace('>', '')}\n"
+            f"   Чанков: {doc['total_chunks']} | "
+            f"Дата: {doc['created_at'].strftime('%d.%m.%Y')}\n"
+            for doc in docs
+        )
+        parts.append("💡 Для удаления: /rag_delete ID")
+        text = "\n".join(parts)
 
         await update.message.reply_text(text)
 
     except Exception as e:
-        logger.error(f"Ошибка получения списка документов: {e}")
+        logger.error("Ошибка получения списка документов: %s", e)
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
@@ -587,24 +710,20 @@ async def handle_rag_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ ID должен быть числом.")
         return
 
-    rag_components = get_rag_components()
-    uploader = rag_components.get('document_uploader')
-
-    if not uploader:
-        await update.message.reply_text("❌ RAG система не инициализирована.")
-        return
+    # Обработчик зарегистрирован только при работающем RAG
+    uploader = context.bot_data[RAG_KEY].uploader
 
     try:
         success = await uploader.delete_document(doc_id)
 
         if success:
             await update.message.reply_text(f"✅ Документ ID={doc_id} удалён.")
-            logger.info(f"Админ {user_id} удалил документ ID={doc_id}")
+            logger.info("Админ %s удалил документ ID=%s", user_id, doc_id)
         else:
             await update.message.reply_text(f"❌ Не удалось удалить документ ID={doc_id}")
 
     except Exception as e:
-        logger.error(f"Ошибка удаления документа: {e}")
+        logger.error("Ошибка удаления документа: %s", e)
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
@@ -614,39 +733,59 @@ async def handle_rag_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def main_async():
     """Точка входа — асинхронная функция"""
     await init_db()
-
-    # ИНИЦИАЛИЗАЦИЯ RAG СИСТЕМЫ
-    rag_initialized = False
-    if settings.RAG_ENABLED and settings.AI_ENABLED:
-        try:
-            rag_initialized = await init_rag_system(settings, ai_assistant)
-            if rag_initialized:
-                logger.info("✅ RAG система инициализирована")
-            else:
-                logger.warning("⚠️ RAG система не инициализирована")
-        except Exception as e:
-            logger.error(f"❌ Ошибка инициализации RAG: {e}")
-            rag_initialized = False
-    else:
-        logger.info("ℹ️ RAG отключён в настройках")
-
-    application = (
+    try:
+        async with AsyncExitStack() as stack:
+            # Без RAG бот работает как обычный AI-ассистент
+            rag = None
+            if settings.AI_ENABLED:
+                try:
+                    # Пул RAG и клиент эмбеддингов закрываются при любом выходе, в том числе при падении на старте
+                    rag = await stack.enter_async_context(rag_system(settings, ai_assistant))
+                    logger.info("✅ RAG система инициализирована")
+                except RagDisabled:
+                    logger.info("ℹ️ RAG отключён в настройках")
+                except RagInitError as e:
+                    logger.warning("⚠️ RAG система не инициализирована: %s", e)
+            await run_bot(rag)
+    finally:
+        await close_db()
+        logger.info("✅ PostgreSQL pool closed")
+        await ai_assistant.aclose()
+        logger.info("✅ Bot stopped successfully")
+
+
+async def run_bot(rag):
+    """Собирает приложение и работает до остановки. rag - RagContext или None, если RAG не работает"""
+    builder = (
         Application.builder()
         .token(BOT_TOKEN)
         .concurrent_updates(True)
-        .build()
+        # Большой пул HTTP/2 соединений к Bot API для параллельных ответов;
+        # getUpdates (long polling) держит соединение подолгу, поэтому у него свой клиент
+        .request(HTTPXRequest(connection_pool_size=256, http_version="2", read_timeout=30, connect_timeout=5))
+        .get_updates_request(HTTPXRequest(connection_pool_size=2, http_version="2", read_timeout=30, connect_timeout=5))
+        # Все исходящие запросы идут через общий лимитер: не больше 28 в секунду на бота,
+        # при RetryAfter запрос ждёт и повторяется, а не роняет обработчик
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
     )
+    # История диалогов переживает перезапуск, если задан Redis
+    if settings.REDIS_URL:
+        builder = builder.persistence(RedisPersistence(settings.REDIS_URL))
+        logger.info("✅ user_data хранится в Redis")
+    application = builder.build()
+    if rag is not None:
+        application.bot_data[RAG_KEY] = rag
 
     # Логируем статус AI
     if settings.AI_ENABLED:
-        logger.info(f"✅ AI включен (model: {ai_assistant.model})")
+        logger.info("✅ AI включен (model: %s)", ai_assistant.model)
         if settings.COLLECT_TRAINING_DATA:
-            logger.info(f"✅ Включена функция фитбэка и записи сообщений")
+            logger.info("✅ Включена функция фитбэка и записи сообщений")
     else:
         logger.info("❌ AI Assistant отключен в настройках")
 
     # Основные обработчики
-    application.add_handler(CallbackQueryHandler(inlinehandler.handler_begin_registartion, pattern="^(registration|info)$"))
+    application.add_handler(CallbackQueryHandler(handler_begin_registration, pattern="^(registration|info)$"))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("exit", logout_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
@@ -656,7 +795,7 @@ async def main_async():
     application.add_handler(CommandHandler("wl_help", wl_help_command))
 
     # Обработчики RAG для админов (загрузка документов)
-    if rag_initialized:
+    if rag is not None:
         # Обработчик загрузки документов (PDF, TXT)
         application.add_handler(MessageHandler(
             filters.Document.ALL,
@@ -674,10 +813,24 @@ async def main_async():
     async with application:
         await application.initialize()
         await application.start()
-        await application.updater.start_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+        if settings.WEBHOOK_URL:
+            # Telegram сам присылает обновления на наш HTTP-сервер, без цикла long polling
+            await application.updater.start_webhook(
+                listen=settings.WEBHOOK_LISTEN,
+                port=settings.WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{settings.WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=settings.WEBHOOK_SECRET or None,
+                max_connections=100,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+            logger.info("✅ Webhook started on %s:%s", settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT)
+        else:
+            await application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
         logger.info("✅ Bot started successfully with concurrent updates enabled")
 
         try:
@@ -687,20 +840,20 @@ async def main_async():
         except KeyboardInterrupt:
             logger.info("Bot stopping by user request...")
         except Exception as e:
-            logger.error(f"Bot error: {e}")
+            logger.error("Bot error: %s", e)
         finally:
-            # Закрываем RAG соединения
-            try:
-                await close_rag_system()
-            except Exception as e:
-                logger.error(f"Ошибка закрытия RAG: {e}")
-
-            await close_db()
-            logger.info("✅ PostgreSQL pool closed")
-            logger.info("✅ Bot stopped successfully")
+            # Дожидаемся фоновых задач (статистика, резюме диалогов), пока пулы ещё открыты
+            await drain()
 
 if __name__ == "__main__":
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    else:
+        # uvloop быстрее стандартного цикла событий; без него работаем на asyncio
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
 
     asyncio.run(main_async())
\ No newline at end of file
@@ -2,71 +2,403 @@
 # Модуль для загрузки и обработки документов в RAG систему
 
 import asyncio
-import hashlib
 import logging
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from typing import List, Dict, Any, Optional
+from typing import Callable, Iterable, List, Dict, Any, Optional, Tuple, Union
+import asyncpg
+import charset_normalizer
 import PyPDF2
 import docx
+from lxml import etree
+from blake3 import blake3
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # без PDFium работаем на PyPDF2
+    pdfium = None
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 logger = logging.getLogger(__name__)
 
+# Сколько чанков отправляем в API эмбеддингов одним запросом (по умолчанию; настраивается RAG_BATCH_SIZE)
+EMBEDDING_BATCH_SIZE = 96
+# Сколько пачек эмбеддингов запрашиваем одновременно
+EMBEDDING_CONCURRENCY = 5
+# Сколько строк чанков записываем в БД одним запросом
+DB_BATCH_SIZE = 500
+# Размер очередей между стадиями конвейера загрузки (ограничивает память при больших файлах)
+PIPELINE_QUEUE_SIZE = 64
+
+# Файлы больше этого размера разбираются в отдельном процессе (обход GIL), меньшие - в потоке
+PROCESS_POOL_THRESHOLD = 5 * 1024 * 1024
+# На сколько диапазонов страниц делим большой PDF (не больше числа ядер)
+PDF_MAX_PARTS = 8
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_pdfium_lock = threading.Lock()
+
+# Разметка WordprocessingML для разбора document.xml без объектной модели python-docx
+_W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+_W_PARAGRAPH = f'{{{_W_NS}}}p'
+_W_TABLE = f'{{{_W_NS}}}tbl'
+_W_TEXT = etree.XPath('.//w:t/text()', namespaces={'w': _W_NS})
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn, а не fork: процесс многопоточный, и форк мог бы унести в воркер захваченный
+        # _pdfium_lock или состояние PDFium посреди вызова - воркер повис бы на первом же PDF
+        _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def shutdown_process_pool():
+    """Останавливает пул процессов разбора документов (при остановке бота)"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+
+async def _run_extraction(extract: Callable[[BytesIO], str], file: BytesIO) -> str:
+    """Запускает синхронный разбор файла в потоке или, для больших файлов, в пуле процессов"""
+    with file.getbuffer() as view:
+        size = view.nbytes
+    if size > PROCESS_POOL_THRESHOLD:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_process_pool(), extract, BytesIO(file.getvalue()))
+    return await asyncio.to_thread(extract, file)
+
+
+# ========================== Синхронное извлечение текста ==============================
+
+def _extract_pdf_text_sync(file: BytesIO) -> str:
+    """Извлекает текст из PDF файла: через PDFium, если он есть, иначе (или при ошибке) через PyPDF2"""
+    if pdfium is not None:
+        try:
+            return _extract_pdf_text_pdfium(file)
+        except Exception as e:
+            logger.warning("PDFium не смог разобрать PDF, пробуем PyPDF2: %s", e)
+    return _extract_pdf_text_pypdf2(file)
+
+
+def _extract_pdf_text_pdfium(file: BytesIO) -> str:
+    """Извлекает текст из PDF через pypdfium2 (C++ PDFium, в разы быстрее PyPDF2)"""
+    file.seek(0)
+    text_parts = _extract_pdf_pages(file)
+
+    # Объединяем текст и удаляем null bytes
+    return "\n\n".join(text_parts).replace('\x00', '')
+
+
+def _extract_pdf_pages(source: Union[BytesIO, bytes, str], start: int = 0, stop: Optional[int] = None) -> List[str]:
+    """
+    Непустой текст страниц [start, stop) через PDFium; выполняется и в воркерах пула процессов.
+    source - содержимое PDF или путь к файлу (PDFium читает с диска только нужные страницы).
+    """
+    # PDFium не потокобезопасен: в одном процессе разбираем не больше одного PDF за раз
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(source)
+        try:
+            text_parts = []
+            for index in range(start, len(pdf) if stop is None else stop):
+                page = pdf[index]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range()
+                textpage.close()
+                page.close()
+                if text and text.strip():
+                    text_parts.append(text)
+        finally:
+            pdf.close()
+    return text_parts
+
+
+def _pdf_page_count(source: Union[bytes, str]) -> int:
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(source)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def _write_temp_pdf(file: BytesIO) -> str:
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+        with file.getbuffer() as view:
+            tmp.write(view)
+    return tmp.name
+
+
+async def _extract_pdf_text_parallel(file: BytesIO) -> str:
+    """
+    Большой PDF: страницы делятся на диапазоны по числу ядер и разбираются в пуле процессов.
+    Документ один раз пишется во временный файл, воркерам уходит только путь -
+    без копии всего PDF в каждую задачу через pickle.
+    """
+    path = await asyncio.to_thread(_write_temp_pdf, file)
+    try:
+        page_count = await asyncio.to_thread(_pdf_page_count, path)
+        # Диапазоны, а не отдельные страницы: каждый воркер открывает документ один раз
+        parts_count = min(os.cpu_count() or 1, PDF_MAX_PARTS)
+        step = max(1, -(-page_count // parts_count))
+        loop = asyncio.get_running_loop()
+        pool = _get_process_pool()
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(pool, _extract_pdf_pages, path, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ))
+    finally:
+        os.unlink(path)
+
+    # Собираем страницы в исходном порядке и удаляем null bytes
+    return "\n\n".join(text for part in parts for text in part).replace('\x00', '')
+
+
+def _extract_pdf_text_pypdf2(file: BytesIO) -> str:
+    """Извлекает текст из PDF через PyPDF2"""
+    try:
+        file.seek(0)
+        pdf_reader = PyPDF2.PdfReader(file)
+
+        text_parts = []
+        for page_num in range(len(pdf_reader.pages)):
+            page = pdf_reader.pages[page_num]
+            text = page.extract_text()
+            if text and text.strip():
+                text_parts.append(text)
+
+        # Объединяем текст и удаляем null bytes
+        full_text = "\n\n".join(text_parts)
+        return full_text.replace('\x00', '')
+
+    except Exception as e:
+        logger.error("Ошибка извлечения текста из PDF: %s", e)
+        return ""
+
+
+def _extract_docx_text_sync(file: BytesIO) -> str:
+    """Извлекает текст из DOCX файла: напрямую из XML через lxml, при ошибке - через python-docx"""
+    try:
+        return _extract_docx_text_lxml(file)
+    except Exception as e:
+        logger.warning("Не удалось разобрать XML DOCX, пробуем python-docx: %s", e)
+    return _extract_docx_text_python_docx(file)
+
+
+def _extract_docx_text_lxml(file: BytesIO) -> str:
+    """Читает word/document.xml из архива и собирает текст параграфов и таблиц в порядке документа"""
+    file.seek(0)
+    with zipfile.ZipFile(file) as archive:
+        root = etree.fromstring(archive.read('word/document.xml'))
+
+    text_parts = []
+    body = root.find(f'{{{_W_NS}}}body')
+    for element in (body if body is not None else ()):
+        if element.tag == _W_PARAGRAPH:
+            text = ''.join(_W_TEXT(element))
+            if text.strip():
+                text_parts.append(text)
+        elif element.tag == _W_TABLE:
+            for row in element.iter(f'{{{_W_NS}}}tr'):
+                cells = (''.join(_W_TEXT(cell)).strip() for cell in row.iterfind(f'{{{_W_NS}}}tc'))
+                row_text = [cell for cell in cells if cell]
+                if row_text:
+                    text_parts.append(" | ".join(row_text))
+
+    # Объединяем и удаляем null bytes
+    return "\n\n".join(text_parts).replace('\x00', '')
+
+
+def _extract_docx_text_python_docx(file: BytesIO) -> str:
+    """Извлекает текст из DOCX через объектную модель python-docx"""
+    try:
+        file.seek(0)
+        doc = docx.Document(file)
+
+        text_parts = []
+        # Извлекаем текст из параграфов
+        for paragraph in doc.paragraphs:
+            if paragraph.text and paragraph.text.strip():
+                text_parts.append(paragraph.text)
+
+        # Извлекаем текст из таблиц
+        for table in doc.tables:
+            for row in table.rows:
+                row_text = []
+                for cell in row.cells:
+                    if cell.text and cell.text.strip():
+                        row_text.append(cell.text.strip())
+                if row_text:
+                    text_parts.append(" | ".join(row_text))
+
+        # Объединяем и удаляем null bytes
+        full_text = "\n\n".join(text_parts)
+        return full_text.replace('\x00', '')
+
+    except Exception as e:
+        logger.error("Ошибка извлечения текста из DOCX: %s", e)
+        return ""
+
+
+def _decode_text_sync(file: BytesIO) -> str:
+    """
+    Декодирует текстовый файл: сначала UTF-8 (самый частый случай, один проход),
+    иначе кодировку определяет charset_normalizer; в крайнем случае UTF-8 с заменой битых байтов.
+    """
+    try:
+        with file.getbuffer() as view:
+            text = str(view, 'utf-8')
+    except UnicodeDecodeError:
+        best = charset_normalizer.from_bytes(file.getvalue()).best()
+        if best is not None:
+            text = str(best)
+        else:
+            with file.getbuffer() as view:
+                text = str(view, 'utf-8', errors='replace')
+
+    # Удаляем null bytes (0x00) - они недопустимы в PostgreSQL
+    return text.replace('\x00', '')
+
 
 class DocumentUploader:
     """Загрузчик и обработчик документов для RAG"""
 
-    def __init__(self, db, embedding_service):
+    def __init__(self, db, embedding_service, batch_size: int = EMBEDDING_BATCH_SIZE):
         self.db = db
         self.embedding_service = embedding_service
-        # Разделитель текста на чанки
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,  # Размер чанка в символах
-            chunk_overlap=200,  # Перекрытие между чанками
-            length_function=len,
+        # Сколько чанков уходит в API эмбеддингов одним запросом
+        self.batch_size = batch_size
+        # Общее на все загрузки ограничение параллельных запросов к API эмбеддингов
+        self._embed_sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        # Разделитель текста на чанки; длина считается в токенах той же кодировки, что у модели эмбеддингов
+        self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name="cl100k_base",
+            chunk_size=800,  # Размер чанка в токенах
+            chunk_overlap=100,  # Перекрытие между чанками
             separators=["\n\n", "\n", ". ", " ", ""]
         )
 
-    async def process_file(self, file_bytes: bytes, filename: str, user_id: int) -> Dict[str, Any]:
+    async def process_file(self, file: Union[BytesIO, bytes], filename: str, user_id: int) -> Dict[str, Any]:
         """
         Обрабатывает файл любого поддерживаемого формата.
         Поддерживаемые форматы: PDF, TXT, MD, DOCX
+        Файл передаётся как BytesIO (читается без лишних копий) или bytes.
         """
+        if not isinstance(file, BytesIO):
+            file = BytesIO(file)
+
         # Определяем тип файла по расширению
         ext = filename.lower().split('.')[-1] if '.' in filename else ''
 
         if ext == 'pdf':
-            return await self.process_pdf(file_bytes, filename, user_id)
+            return await self.process_pdf(file, filename, user_id)
         elif ext in ['txt', 'md', 'text']:
-            return await self.process_text(file_bytes, filename, user_id)
+            return await self.process_text(file, filename, user_id)
         elif ext in ['docx', 'doc']:
-            return await self.process_docx(file_bytes, filename, user_id)
+            return await self.process_docx(file, filename, user_id)
         else:
             return {
                 'success': False,
                 'error': f'Неподдерживаемый формат файла: .{ext}. Используйте PDF, TXT, MD или DOCX.'
             }
 
-    async def process_pdf(self, file_bytes: bytes, filename: str, user_id: int) -> Dict[str, Any]:
+    async def upload_many(self, files: Iterable[Tuple[Union[BytesIO, bytes], str]],
+                          user_id: int) -> List[Dict[str, Any]]:
+        """
+        Загружает несколько файлов (файл, имя) за раз.
+        Новые чанки всех файлов идут в API эмбеддингов общими пачками по batch_size,
+        поэтому мелкие документы не тратят по запросу каждый. Каждый документ пишется своей транзакцией.
+        Возвращает результаты в порядке files, в том же формате, что process_file.
+        """
+        files = [(file if isinstance(file, BytesIO) else BytesIO(file), filename) for file, filename in files]
+        results: List[Optional[Dict[str, Any]]] = [None] * len(files)
+
+        # 1. Хеши и тексты всех файлов считаются одновременно
+        extracted = await asyncio.gather(
+            *(self._read_document(file, filename) for file, filename in files), return_exceptions=True
+        )
+
+        # 2. Отсеиваем дубликаты (в том числе внутри самой пачки) и пустые файлы, режем тексты на чанки
+        documents = []
+        seen = set()
+        for index, ((_, filename), item) in enumerate(zip(files, extracted)):
+            if isinstance(item, Exception):
+                results[index] = {'success': False, 'error': str(item)}
+                continue
+            file_hash, text = item
+            if file_hash in seen or self.db.is_duplicate(file_hash):
+                results[index] = {'success': False, 'error': 'Этот документ уже загружен'}
+                continue
+            if not text or len(text.strip()) < 10:
+                results[index] = {'success': False, 'error': 'Не удалось извлечь текст из файла'}
+                continue
+            seen.add(file_hash)
+            documents.append((index, filename, file_hash, text, self.text_splitter.split_text(text)))
+
+        # 3. Эмбеддинги всех новых чанков - общими пачками
+        known = await self._embed_all([chunk for *_, chunks in documents for chunk in chunks])
+
+        # 4. Запись документов; эмбеддинги берутся из готового словаря
+        for index, filename, file_hash, text, chunks in documents:
+            results[index] = await self._process_and_save(
+                text, filename, file_hash, user_id, chunks=chunks, known=known
+            )
+        return results
+
+    async def _read_document(self, file: BytesIO, filename: str) -> Tuple[str, str]:
+        """Хеш файла и его текст; формат определяется по расширению"""
+        ext = filename.lower().split('.')[-1] if '.' in filename else ''
+        if ext == 'pdf':
+            extract = self._extract_pdf_text
+        elif ext in ['txt', 'md', 'text']:
+            extract = self._decode_text
+        elif ext in ['docx', 'doc']:
+            extract = self._extract_docx_text
+        else:
+            raise ValueError(f'Неподдерживаемый формат файла: .{ext}. Используйте PDF, TXT, MD или DOCX.')
+        file_hash, text = await asyncio.gather(self._hash_file(file), extract(file))
+        return file_hash, text
+
+    async def _embed_all(self, chunks: List[str]) -> Dict[str, Any]:
+        """
+        Эмбеддинги набора чанков: хеш текста -> вектор.
+        Сохранённые в базе берутся оттуда, остальные уникальные тексты запрашиваются пачками по batch_size.
+        """
+        texts = {self._chunk_hash(chunk_text): chunk_text for chunk_text in chunks}
+        if not texts:
+            return {}
+        embeddings = await self.db.find_embeddings(list(texts))
+        missing = [(h, chunk_text) for h, chunk_text in texts.items() if h not in embeddings]
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+        created = await asyncio.gather(
+            *(self._embed_batch([chunk_text for _, chunk_text in batch]) for batch in batches)
+        )
+        for batch, vectors in zip(batches, created):
+            embeddings.update((h, e) for (h, _), e in zip(batch, vectors) if e is not None)
+        return embeddings
+
+    async def process_pdf(self, file: BytesIO, filename: str, user_id: int) -> Dict[str, Any]:
         """Обрабатывает PDF файл"""
         try:
-            # 1. Вычисляем хеш файла для проверки дубликатов
-            file_hash = hashlib.md5(file_bytes).hexdigest()
-
-            # 2. Проверяем, не загружался ли уже этот файл
-            async with self.db.pool.acquire() as conn:
-                existing = await conn.fetchval(
-                    "SELECT id FROM rag_documents WHERE file_hash = $1",
-                    file_hash
-                )
-                if existing:
-                    return {
-                        'success': False,
-                        'error': 'Этот документ уже загружен'
-                    }
+            # 1. Хеш файла и текст из PDF считаются одновременно
+            file_hash, text = await asyncio.gather(self._hash_file(file), self._extract_pdf_text(file))
+
+            # 2. Проверяем, не загружался ли уже этот файл (текст дубликата просто отбрасываем)
+            if self.db.is_duplicate(file_hash):
+                return {
+                    'success': False,
+                    'error': 'Этот документ уже загружен'
+                }
 
-            # 3. Извлекаем текст из PDF
-            text = await self._extract_pdf_text(file_bytes)
+            # 3. Проверяем извлечённый текст
 
             if not text or len(text.strip()) < 10:
                 return {
@@ -78,43 +410,26 @@ class DocumentUploader:
             return await self._process_and_save(text, filename, file_hash, user_id)
 
         except Exception as e:
-            logger.error(f"Ошибка обработки PDF: {e}")
+            logger.error("Ошибка обработки PDF: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    async def process_text(self, file_bytes: bytes, filename: str, user_id: int) -> Dict[str, Any]:
+    async def process_text(self, file: BytesIO, filename: str, user_id: int) -> Dict[str, Any]:
         """Обрабатывает текстовый файл (TXT, MD)"""
         try:
-            # 1. Вычисляем хеш файла
-            file_hash = hashlib.md5(file_bytes).hexdigest()
+            # 1. Хеш файла и декодирование текста считаются одновременно
+            file_hash, text = await asyncio.gather(self._hash_file(file), self._decode_text(file))
 
             # 2. Проверяем дубликаты
-            async with self.db.pool.acquire() as conn:
-                existing = await conn.fetchval(
-                    "SELECT id FROM rag_documents WHERE file_hash = $1",
-                    file_hash
-                )
-                if existing:
-                    return {
-                        'success': False,
-                        'error': 'Этот документ уже загружен'
-                    }
-
-            # 3. Декодируем текст (пробуем разные кодировки)
-            text = None
-            for encoding in ['utf-8', 'cp1251', 'latin-1']:
-                try:
-                    text = file_bytes.decode(encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-
-            # Удаляем null bytes (0x00) - они недопустимы в PostgreSQL
-            if text:
-                text = text.replace('\x00', '')
+            if self.db.is_duplicate(file_hash):
+                return {
+                    'success': False,
+                    'error': 'Этот документ уже загружен'
+                }
 
+            # 3. Проверяем декодированный текст
             if not text or len(text.strip()) < 10:
                 return {
                     'success': False,
@@ -125,32 +440,26 @@ class DocumentUploader:
             return await self._process_and_save(text, filename, file_hash, user_id)
 
         except Exception as e:
-            logger.error(f"Ошибка обработки текстового файла: {e}")
+            logger.error("Ошибка обработки текстового файла: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    async def process_docx(self, file_bytes: bytes, filename: str, user_id: int) -> Dict[str, Any]:
+    async def process_docx(self, file: BytesIO, filename: str, user_id: int) -> Dict[str, Any]:
         """Обрабатывает DOCX файл (Word документ)"""
         try:
-            # 1. Вычисляем хеш файла
-            file_hash = hashlib.md5(file_bytes).hexdigest()
+            # 1. Хеш файла и текст из DOCX считаются одновременно
+            file_hash, text = await asyncio.gather(self._hash_file(file), self._extract_docx_text(file))
 
             # 2. Проверяем дубликаты
-            async with self.db.pool.acquire() as conn:
-                existing = await conn.fetchval(
-                    "SELECT id FROM rag_documents WHERE file_hash = $1",
-                    file_hash
-                )
-                if existing:
-                    return {
-                        'success': False,
-                        'error': 'Этот документ уже загружен'
-                    }
+            if self.db.is_duplicate(file_hash):
+                return {
+                    'success': False,
+                    'error': 'Этот документ уже загружен'
+                }
 
-            # 3. Извлекаем текст из DOCX
-            text = await self._extract_docx_text(file_bytes)
+            # 3. Проверяем извлечённый текст
 
             if not text or len(text.strip()) < 10:
                 return {
@@ -162,48 +471,155 @@ class DocumentUploader:
             return await self._process_and_save(text, filename, file_hash, user_id)
 
         except Exception as e:
-            logger.error(f"Ошибка обработки DOCX файла: {e}")
+            logger.error("Ошибка обработки DOCX файла: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    async def _extract_docx_text(self, file_bytes: bytes) -> str:
-        """Извлекает текст из DOCX файла"""
-        try:
-            docx_file = BytesIO(file_bytes)
-            doc = docx.Document(docx_file)
+    async def _extract_docx_text(self, file: BytesIO) -> str:
+        """Извлекает текст из DOCX файла (вне цикла событий)"""
+        return await _run_extraction(_extract_docx_text_sync, file)
 
-            text_parts = []
-            # Извлекаем текст из параграфов
-            for paragraph in doc.paragraphs:
-                if paragraph.text and paragraph.text.strip():
-                    text_parts.append(paragraph.text)
-
-            # Извлекаем текст из таблиц
-            for table in doc.tables:
-                for row in table.rows:
-                    row_text = []
-                    for cell in row.cells:
-                        if cell.text and cell.text.strip():
-                            row_text.append(cell.text.strip())
-                    if row_text:
-                        text_parts.append(" | ".join(row_text))
-
-            # Объединяем и удаляем null bytes
-            full_text = "\n\n".join(text_parts)
-            return full_text.replace('\x00', '')
+    async def _decode_text(self, file: BytesIO) -> str:
+        """Декодирует текстовый файл (вне цикла событий)"""
+        return await _run_extraction(_decode_text_sync, file)
 
-        except Exception as e:
-            logger.error(f"Ошибка извлечения текста из DOCX: {e}")
-            return ""
+    async def _hash_file(self, file: BytesIO) -> str:
+        """Хеш файла в отдельном потоке, параллельно с извлечением текста"""
+        return await asyncio.to_thread(self._file_hash, file)
 
-    async def _process_and_save(self, text: str, filename: str,
-                                file_hash: str, user_id: int) -> Dict[str, Any]:
-        """Разбивает текст на чанки, создаёт эмбеддинги и сохраняет в БД"""
+    @staticmethod
+    def _file_hash(file: BytesIO) -> str:
+        """
+        BLAKE3 содержимого файла прямо по буферу BytesIO, без копии в bytes.
+        Большие файлы хешируются на всех ядрах; 32 hex-символа, как раньше у MD5.
+        """
+        with file.getbuffer() as view:
+            return blake3(view, max_threads=blake3.AUTO).hexdigest()[:32]
+
+    @staticmethod
+    def _chunk_hash(text: str) -> str:
+        """Хеш текста чанка (BLAKE3, 32 hex-символа) для повторного использования эмбеддингов"""
+        return blake3(text.encode('utf-8')).hexdigest()[:32]
+
+    async def _embed_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Эмбеддинги одной пачки; не больше EMBEDDING_CONCURRENCY пачек одновременно"""
+        async with self._embed_sem:
+            # Небольшой разброс старта, чтобы параллельные запросы не приходили в API одной волной
+            await asyncio.sleep(random.uniform(0, 0.05))
+            return await self.embedding_service.create_embeddings_batch(texts)
+
+    async def _embed_and_store(self, chunks: List[str], doc_id: int, filename: str, user_id: int,
+                               conn: Optional[asyncpg.Connection] = None,
+                               known: Optional[Dict[str, Any]] = None) -> Tuple[int, int]:
+        """
+        Конвейер из трёх стадий, связанных очередями с ограниченным размером:
+        пачки по batch_size чанков -> EMBEDDING_CONCURRENCY воркеров эмбеддингов -> запись в БД по DB_BATCH_SIZE строк.
+        Чанки, чей текст уже есть в базе (или в known - заранее посчитанных эмбеддингах), берут готовый вектор.
+        Возвращает (сохранено чанков, пропущено из-за ошибок эмбеддинга).
+        """
+        slices: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        rows: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        processed = 0
+        failed = 0
+        reused = 0
+
+        async def produce():
+            for start in range(0, len(chunks), self.batch_size):
+                await slices.put((start, chunks[start:start + self.batch_size]))
+            for _ in range(EMBEDDING_CONCURRENCY):
+                await slices.put(None)
+
+        async def embed():
+            nonlocal failed, reused
+            while (item := await slices.get()) is not None:
+                start, batch = item
+                hashes = [self._chunk_hash(chunk_text) for chunk_text in batch]
+                # Готовые эмбеддинги из базы; в API уходят только новые тексты, каждый по одному разу
+                if known is not None:
+                    embeddings = {h: known[h] for h in hashes if h in known}
+                else:
+                    embeddings = await self.db.find_embeddings(hashes)
+                missing = {h: chunk_text for chunk_text, h in zip(batch, hashes) if h not in embeddings}
+                reused += len(batch) - sum(h in missing for h in hashes)
+                if missing:
+                    created = await self._embed_batch(list(missing.values()))
+                    embeddings.update((h, e) for h, e in zip(missing, created) if e is not None)
+
+                for i, (chunk_text, h) in enumerate(zip(batch, hashes), start=start):
+                    embedding = embeddings.get(h)
+                    # Пропускаем чанк если эмбеддинг не создался
+                    if embedding is None:
+                        logger.warning("Пропущен чанк %d - ошибка создания эмбеддинга", i)
+                        failed += 1
+                        continue
+                    await rows.put((i, chunk_text, h, embedding))
+
+        def chunk_rows(buffer):
+            return [
+                (doc_id, i, chunk_text, embedding, {
+                    'filename': filename,
+                    'chunk_index': i,
+                    'total_chunks': len(chunks),
+                    'uploaded_by': user_id
+                }, h)
+                for i, chunk_text, h, embedding in buffer
+            ]
+
+        async def store():
+            nonlocal processed
+            buffer = []
+            while True:
+                row = await rows.get()
+                if row is None:
+                    # Последняя пачка вместе со счётчиком чанков документа - одной транзакцией
+                    await self.db.add_chunks_bulk(
+                        chunk_rows(buffer), document_id=doc_id, total_chunks=processed + len(buffer), conn=conn
+                    )
+                    processed += len(buffer)
+                    return
+                buffer.append(row)
+                if len(buffer) >= DB_BATCH_SIZE:
+                    await self.db.add_chunks_bulk(chunk_rows(buffer), conn=conn)
+                    processed += len(buffer)
+                    buffer = []
+
+        async def finish_embedding():
+            await asyncio.gather(producer, *embedders)
+            await rows.put(None)
+
+        producer = asyncio.create_task(produce())
+        embedders = [asyncio.create_task(embed()) for _ in range(EMBEDDING_CONCURRENCY)]
+        storer = asyncio.create_task(store())
+        finisher = asyncio.create_task(finish_embedding())
+        tasks = (producer, *embedders, storer, finisher)
+        try:
+            # Ждём все стадии сразу: если упадёт запись в БД, эмбеддеры не повиснут на полной очереди
+            await asyncio.gather(finisher, storer)
+        except BaseException:
+            # Ошибка на любой стадии останавливает весь конвейер. Дожидаемся отмены,
+            # чтобы откат транзакции не начался, пока на том же соединении ещё идёт COPY
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if reused:
+            logger.info("Эмбеддинги %d чанков взяты из базы без запроса к API", reused)
+        return processed, failed
+
+    async def _process_and_save(self, text: str, filename: str, file_hash: str, user_id: int,
+                                chunks: Optional[List[str]] = None,
+                                known: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Разбивает текст на чанки, создаёт эмбеддинги и сохраняет в БД.
+        chunks и known передаёт upload_many: чанки уже нарезаны, эмбеддинги уже посчитаны.
+        """
         try:
             # 1. Разбиваем текст на чанки
-            chunks = self.text_splitter.split_text(text)
+            if chunks is None:
+                chunks = self.text_splitter.split_text(text)
 
             if not chunks:
                 return {
@@ -211,46 +627,17 @@ class DocumentUploader:
                     'error': 'Не удалось разбить документ на части'
                 }
 
-            # 2. Добавляем документ в БД
-            doc_id = await self.db.add_document(filename, file_hash, user_id)
-
-            # 3. Обрабатываем каждый чанк
-            processed_chunks = 0
-            failed_chunks = 0
-            for i, chunk_text in enumerate(chunks):
-                # Создаём эмбеддинг для чанка
-                embedding = await self.embedding_service.create_embedding(chunk_text)
-
-                # Пропускаем чанк если эмбеддинг не создался
-                if embedding is None:
-                    logger.warning(f"Пропущен чанк {i} - ошибка создания эмбеддинга")
-                    failed_chunks += 1
-                    continue
-
-                # Сохраняем чанк в БД
-                await self.db.add_chunk(
-                    document_id=doc_id,
-                    chunk_index=i,
-                    content=chunk_text,
-                    embedding=embedding,
-                    metadata={
-                        'filename': filename,
-                        'chunk_index': i,
-                        'total_chunks': len(chunks),
-                        'uploaded_by': user_id
-                    }
-                )
-                processed_chunks += 1
+            # Вся запись документа - на одном соединении в одной транзакции (при ошибке откатывается целиком)
+            async with self.db.upload_transaction(file_hash) as conn:
+                # 2. Добавляем документ в БД
+                doc_id = await self.db.add_document(filename, file_hash, user_id, conn=conn)
 
-            # 4. Обновляем счётчик чанков в документе
-            async with self.db.pool.acquire() as conn:
-                await conn.execute("""
-                    UPDATE rag_documents 
-                    SET total_chunks = $1 
-                    WHERE id = $2
-                """, processed_chunks, doc_id)
+                # 3-5. Эмбеддинги и запись в БД идут конвейером: пока одни пачки ждут API, готовые уже пишутся
+                processed_chunks, failed_chunks = await self._embed_and_store(
+                    chunks, doc_id, filename, user_id, conn, known
+                )
 
-            logger.info(f"Документ {filename} обработан: {processed_chunks} чанков")
+            logger.info("Документ %s обработан: %d чанков", filename, processed_chunks)
 
             return {
                 'success': True,
@@ -261,39 +648,29 @@ class DocumentUploader:
             }
 
         except Exception as e:
-            logger.error(f"Ошибка сохранения документа: {e}")
+            logger.error("Ошибка сохранения документа: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    async def _extract_pdf_text(self, file_bytes: bytes) -> str:
-        """Извлекает текст из PDF файла"""
-        try:
-            pdf_file = BytesIO(file_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-
-            text_parts = []
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text = page.extract_text()
-                if text and text.strip():
-                    text_parts.append(text)
-
-            # Объединяем текст и удаляем null bytes
-            full_text = "\n\n".join(text_parts)
-            return full_text.replace('\x00', '')
-
-        except Exception as e:
-            logger.error(f"Ошибка извлечения текста из PDF: {e}")
-            return ""
+    async def _extract_pdf_text(self, file: BytesIO) -> str:
+        """Извлекает текст из PDF файла (вне цикла событий; большие файлы - постранично на всех ядрах)"""
+        with file.getbuffer() as view:
+            size = view.nbytes
+        if pdfium is not None and size > PROCESS_POOL_THRESHOLD:
+            try:
+                return await _extract_pdf_text_parallel(file)
+            except Exception as e:
+                logger.warning("Параллельный разбор PDF не удался, разбираем целиком: %s", e)
+        return await _run_extraction(_extract_pdf_text_sync, file)
 
     async def delete_document(self, document_id: int) -> bool:
         """Удаляет документ и все его чанки из БД"""
         try:
             return await self.db.delete_document(document_id)
         except Exception as e:
-            logger.error(f"Ошибка удаления документа: {e}")
+            logger.error("Ошибка удаления документа: %s", e)
             return False
 
     async def get_documents_list(self) -> List[Dict]:
@@ -301,7 +678,7 @@ class DocumentUploader:
         try:
             return await self.db.get_all_documents()
         except Exception as e:
-            logger.error(f"Ошибка получения списка документов: {e}")
+            logger.error("Ошибка получения списка документов: %s", e)
             return []
 
 
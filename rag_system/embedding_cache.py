@@ -0,0 +1,97 @@
+# embedding_cache.py
+# Кэш эмбеддингов на диске (SQLite) перед EmbeddingService: одинаковый текст не отправляется в API повторно
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from blake3 import blake3
+
+logger = logging.getLogger(__name__)
+
+# Сколько ключей читаем из SQLite одним запросом (лимит параметров запроса)
+_SELECT_BATCH = 500
+
+
+class CachedEmbeddingService:
+    """
+    Обёртка с тем же интерфейсом, что у EmbeddingService.
+    Ключ - BLAKE3 от (модель, размерность, текст): после смены модели старые записи просто не находятся.
+    Векторы хранятся как float32.
+    """
+
+    def __init__(self, service, path: str, model_id: Optional[str] = None):
+        self.service = service
+        self.model = service.model
+        self.dimensions = service.dimensions
+        self._model_key = f"{model_id or service.model}:{service.dimensions}"
+        # Запросы к SQLite идут из потоков to_thread, поэтому одно соединение под общим замком
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL
+                ) WITHOUT ROWID;
+            """)
+        logger.info("✅ Кэш эмбеддингов: %s", path)
+
+    def _key(self, text: str) -> str:
+        return blake3(f"{self._model_key}\x00{text}".encode('utf-8')).hexdigest()
+
+    def _get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SELECT_BATCH):
+                batch = keys[i:i + _SELECT_BATCH]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def _put_many(self, embeddings: Dict[str, List[float]]):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in embeddings.items())
+            )
+            self._db.commit()
+
+    async def create_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Эмбеддинги из кэша; в API уходят только промахи, новые результаты сохраняются"""
+        keys = [self._key(text) for text in texts]
+        found = await asyncio.to_thread(self._get_many, keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            created = await self.service.create_embeddings_batch(list(missing.values()))
+            new = {key: embedding for key, embedding in zip(missing, created) if embedding is not None}
+            if new:
+                await asyncio.to_thread(self._put_many, new)
+                found.update(new)
+
+        return [found.get(key) for key in keys]
+
+    async def create_embedding(self, text: str) -> Optional[List[float]]:
+        return (await self.create_embeddings_batch([text]))[0]
+
+    async def warmup(self):
+        await self.service.warmup()
+
+    async def aclose(self):
+        await self.service.aclose()
+        with self._lock:
+            self._db.close()
@@ -4,17 +4,35 @@
 import asyncio
 import logging
 from typing import List, Optional
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, RateLimitError
 
 logger = logging.getLogger(__name__)
 
+# Модель эмбеддингов и размерность вектора (3-small умеет отдавать укороченные векторы)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512
+
+# Сколько раз повторяем пакетный запрос после 429 (Too Many Requests); свои повторы SDK отключены
+RATE_LIMIT_RETRIES = 3
+# Потолок паузы перед повтором: большой Retry-After не должен надолго останавливать конвейер загрузки
+RATE_LIMIT_MAX_DELAY = 20.0
+
 
 class EmbeddingService:
     """Сервис для создания эмбеддингов текста через OpenAI API"""
 
     def __init__(self, api_key: str):
-        self.client = AsyncOpenAI(api_key=api_key)
-        self.model = "text-embedding-ada-002"  # 1536 размерность вектора
+        # Свой HTTP/2 клиент с keep-alive: параллельные пачки эмбеддингов идут по уже открытым соединениям
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            http2=True
+        )
+        # max_retries=0: 429 повторяет create_embeddings_batch, иначе повторы SDK умножаются на наши
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.model = EMBEDDING_MODEL
+        self.dimensions = EMBEDDING_DIMENSIONS
 
     async def create_embedding(self, text: str) -> Optional[List[float]]:
         """
@@ -22,41 +40,66 @@ class EmbeddingService:
         Возвращает список float или None при ошибке.
         """
         try:
-            # Обрезаем слишком длинный текст (лимит токенов)
-            if len(text) > 8000:
-                text = text[:8000]
-
             response = await self.client.embeddings.create(
                 model=self.model,
-                input=text
+                input=text,
+                dimensions=self.dimensions
             )
             return response.data[0].embedding
 
         except Exception as e:
-            logger.error(f"Ошибка создания эмбеддинга: {e}")
+            logger.error("Ошибка создания эмбеддинга: %s", e)
             # Возвращаем None вместо нулевого вектора чтобы обработать ошибку
             return None
 
+    @staticmethod
+    def _retry_after(error: RateLimitError, attempt: int) -> float:
+        """Пауза перед повтором: заголовок Retry-After, иначе экспоненциальная задержка (не больше RATE_LIMIT_MAX_DELAY)"""
+        try:
+            delay = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError, AttributeError):
+            delay = 2 ** attempt
+        return min(delay, RATE_LIMIT_MAX_DELAY)
+
     async def create_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
         """
         Создаёт эмбеддинги для пакета текстов.
         Возвращает список эмбеддингов (или None для неудачных).
         """
         try:
-            # Обрезаем слишком длинные тексты
-            processed_texts = [t[:8000] if len(t) > 8000 else t for t in texts]
-
-            response = await self.client.embeddings.create(
-                model=self.model,
-                input=processed_texts
-            )
-            return [data.embedding for data in response.data]
+            # Обрезать тексты не нужно: чанки режутся по токенам и укладываются в лимит модели
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                try:
+                    response = await self.client.embeddings.create(
+                        model=self.model,
+                        input=texts,
+                        dimensions=self.dimensions
+                    )
+                    return [data.embedding for data in response.data]
+                except RateLimitError as e:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    delay = self._retry_after(e, attempt)
+                    logger.warning("⏳ Лимит запросов к API эмбеддингов, повтор через %.1fс", delay)
+                    await asyncio.sleep(delay)
 
         except Exception as e:
-            logger.error(f"Ошибка пакетного создания эмбеддингов: {e}")
+            logger.error("Ошибка пакетного создания эмбеддингов: %s", e)
             # Возвращаем список None для каждого текста
             return [None] * len(texts)
 
+    async def warmup(self):
+        """Открывает соединение с API заранее (и проверяет ключ), чтобы первая загрузка не ждала TLS"""
+        try:
+            await self.client.models.retrieve(self.model)
+            logger.info("✅ Соединение с API эмбеддингов установлено")
+        except Exception as e:
+            logger.warning("⚠️ Не удалось прогреть соединение с API эмбеддингов: %s", e)
+
+    async def aclose(self):
+        """Закрывает HTTP-клиент OpenAI"""
+        await self.http_client.aclose()
+
 
 # Глобальный экземпляр
 embedding_service: Optional[EmbeddingService] = None
@@ -1,39 +1,163 @@
 # rag_database.py
 # Модуль для работы с векторной базой данных RAG
 
+import asyncio
 import asyncpg
 import logging
-from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
+from pgvector.asyncpg import register_vector
+from typing import AsyncIterator, Awaitable, Callable, Optional, List, Dict, Any, Set, Tuple
 import json
+from .embedding_service import EMBEDDING_DIMENSIONS
 
 logger = logging.getLogger(__name__)
 
+# Параметры HNSW-индекса по эмбеддингам: больше - точнее поиск, но медленнее построение/запрос
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+# Очередь кандидатов при поиске: по умолчанию в pgvector 40; больше - выше полнота выдачи.
+# Должна быть не меньше числа запрашиваемых кандидатов (RAGEngine.candidate_k = 20) с запасом под отсечение по порогу
+HNSW_EF_SEARCH = 100
+# Построение HNSW-индекса по уже заполненной таблице может идти дольше обычного command_timeout
+HNSW_BUILD_TIMEOUT = 600
+
+# Как часто пишем в лог заполненность пула (для подбора его размера)
+POOL_STATS_INTERVAL = 30
+
+# --- Горячие запросы ---
+# asyncpg готовит каждый запрос один раз на соединение и держит его в кэше выражений,
+# поэтому текст запросов вынесен в константы и должен совпадать байт в байт
+SQL_INSERT_DOCUMENT = """
+    INSERT INTO rag_documents (filename, file_hash, uploaded_by)
+    VALUES ($1, $2, $3)
+    RETURNING id
+"""
+SQL_SET_TOTAL_CHUNKS = "UPDATE rag_documents SET total_chunks = $1 WHERE id = $2"
+SQL_FIND_EMBEDDINGS = """
+    SELECT DISTINCT ON (content_hash) content_hash, embedding
+    FROM rag_chunks
+    WHERE content_hash = ANY($1::char(32)[])
+"""
+# Поиск по косинусному сходству (1 - distance = similarity); {columns} - эмбеддинги чанков, если нужны
+_SQL_SEARCH_CHUNKS = """
+    SELECT
+        c.id,
+        c.content,
+        c.metadata,{columns}
+        d.filename,
+        1 - (c.embedding <=> $1) as similarity
+    FROM rag_chunks c
+    JOIN rag_documents d ON c.document_id = d.id
+    ORDER BY c.embedding <=> $1
+    LIMIT $2
+"""
+SQL_SEARCH_CHUNKS = _SQL_SEARCH_CHUNKS.format(columns="")
+SQL_SEARCH_CHUNKS_WITH_EMBEDDINGS = _SQL_SEARCH_CHUNKS.format(columns="\n        c.embedding,")
+SQL_LOG_USAGE = """
+    INSERT INTO rag_usage_stats (user_id, query, chunks_used, response_time_ms)
+    VALUES ($1, $2, $3, $4)
+"""
+# Вся статистика одним запросом: четыре счётчика за один round trip
+SQL_STATS = """
+    SELECT
+        (SELECT count(*) FROM rag_documents) AS documents_count,
+        (SELECT count(*) FROM rag_chunks) AS chunks_count,
+        (SELECT count(*) FROM rag_usage_stats WHERE created_at >= CURRENT_DATE) AS queries_today,
+        (SELECT count(*) FROM rag_usage_stats) AS total_queries
+"""
+
 # Глобальный пул соединений для RAG
 _rag_pool: Optional[asyncpg.Pool] = None
 
 class RAGDatabase:
     """Класс для работы с RAG базой данных"""
 
-    def __init__(self, database_url: str):
+    def __init__(self, database_url: str, min_size: int = 10, max_size: int = 25):
         self.database_url = database_url
+        self.min_size = min_size
+        self.max_size = max_size
         self.pool: Optional[asyncpg.Pool] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        # Растёт при любом изменении базы знаний; по нему устаревают кэши результатов поиска
+        self.index_version = 0
+        # Хеши уже загруженных файлов: проверка дубликата без запроса к БД
+        self._known_hashes: Set[str] = set()
+        # Размерность колонки embedding в существующей таблице (может остаться от прежней модели)
+        self.stored_dimensions: Optional[int] = None
+
+    @property
+    def needs_reembedding(self) -> bool:
+        """Чанки сохранены под другую размерность: до reembed_chunks поиск по ним невозможен"""
+        return self.stored_dimensions != EMBEDDING_DIMENSIONS
 
     async def connect(self):
         """Подключается к базе данных"""
+        # Тип vector должен существовать до создания пула: каждое соединение пула регистрирует для него кодек
+        bootstrap = await asyncpg.connect(self.database_url)
+        try:
+            await bootstrap.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        finally:
+            await bootstrap.close()
+
         self.pool = await asyncpg.create_pool(
             self.database_url,
-            min_size=2,
-            max_size=10
+            min_size=self.min_size,
+            max_size=self.max_size,
+            max_inactive_connection_lifetime=300,
+            max_queries=50000,
+            command_timeout=30,
+            statement_cache_size=1024,
+            init=self._init_connection,
+            # Параметр сессии при подключении: переживает RESET ALL при возврате соединения в пул
+            server_settings={'hnsw.ef_search': str(HNSW_EF_SEARCH)}
         )
         await self._create_tables()
-        logger.info("✅ RAGDatabase connected")
+        await self._load_known_hashes()
+        self._stats_task = asyncio.create_task(self._pool_stats_loop())
+        logger.info("✅ RAGDatabase connected (pool %s-%s)", self.min_size, self.max_size)
+
+    async def prewarm(self):
+        """
+        Прогрев пула при запуске: на каждом из min_size соединений проверяет pgvector и готовит запрос поиска
+        (LIMIT 0 - ничего не читает), чтобы первый вопрос пользователя не ждал разбор и планирование.
+        """
+        async def warm():
+            async with self.pool.acquire() as conn:
+                if not await conn.fetchval("SELECT EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'vector')"):
+                    raise RuntimeError("pgvector extension is not installed in the RAG database")
+                if self.needs_reembedding:
+                    return
+                await conn.fetch(SQL_SEARCH_CHUNKS_WITH_EMBEDDINGS, [0.0] * EMBEDDING_DIMENSIONS, 0)
+
+        await asyncio.gather(*(warm() for _ in range(self.min_size)))
+        logger.info("✅ RAG pool prewarmed (%s connections)", self.min_size)
+
+    async def close(self):
+        """Останавливает логирование пула и закрывает соединения"""
+        if self._stats_task:
+            self._stats_task.cancel()
+            self._stats_task = None
+        if self.pool:
+            await self.pool.close()
+
+    async def _pool_stats_loop(self):
+        """Периодически пишет в лог размер пула; если свободных соединений нет - предупреждение"""
+        while True:
+            await asyncio.sleep(POOL_STATS_INTERVAL)
+            size, idle = self.pool.get_size(), self.pool.get_idle_size()
+            if size >= self.max_size and not idle:
+                logger.warning("⚠️ RAG pool saturated: %s/%s connections busy", size, self.max_size)
+            else:
+                logger.debug("RAG pool: size=%s, idle=%s, max=%s", size, idle, self.max_size)
+
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection):
+        """Бинарный кодек pgvector: эмбеддинги передаются списками float без перевода в текст"""
+        await register_vector(conn)
 
     async def _create_tables(self):
         """Создаёт таблицы для RAG"""
         async with self.pool.acquire() as conn:
-            # Расширение pgvector
-            await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
-
             # Таблица документов
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS rag_documents (
@@ -47,18 +171,41 @@ class RAGDatabase:
             """)
 
             # Таблица чанков с векторами
-            await conn.execute("""
+            await conn.execute(f"""
                 CREATE TABLE IF NOT EXISTS rag_chunks (
                     id SERIAL PRIMARY KEY,
                     document_id INTEGER REFERENCES rag_documents(id) ON DELETE CASCADE,
                     chunk_index INTEGER NOT NULL,
                     content TEXT NOT NULL,
-                    embedding vector(1536),
-                    metadata JSONB DEFAULT '{}',
+                    content_hash CHAR(32),
+                    embedding vector({EMBEDDING_DIMENSIONS}),
+                    metadata JSONB DEFAULT '{{}}',
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
 
+            self.stored_dimensions = await self._embedding_dimensions(conn)
+
+            # Хеш текста чанка: одинаковые чанки в новых загрузках берут готовый эмбеддинг
+            await conn.execute("ALTER TABLE rag_chunks ADD COLUMN IF NOT EXISTS content_hash CHAR(32)")
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS rag_chunks_content_hash_idx ON rag_chunks (content_hash)"
+            )
+
+            if self.needs_reembedding:
+                # Индекс пересоздаётся в reembed_chunks, когда колонка будет нужной размерности
+                logger.warning(
+                    "⚠️ rag_chunks.embedding is vector(%s), expected vector(%s): chunks need re-embedding",
+                    self.stored_dimensions, EMBEDDING_DIMENSIONS
+                )
+            else:
+                await self._create_hnsw_index(conn)
+
+            # Индекс по внешнему ключу: каскадное удаление документа не сканирует все чанки
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS rag_chunks_document_id_idx ON rag_chunks (document_id)"
+            )
+
             # Таблица статистики
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS rag_usage_stats (
@@ -73,62 +220,160 @@ class RAGDatabase:
 
             logger.info("✅ RAG tables initialized")
 
-    async def add_document(self, filename: str, file_hash: str, user_id: int) -> int:
-        """Добавляет документ в базу, возвращает ID"""
+    @staticmethod
+    async def _create_hnsw_index(conn: asyncpg.Connection):
+        """HNSW-индекс для поиска по косинусному расстоянию вместо полного перебора чанков"""
+        await conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS rag_chunks_emb_hnsw ON rag_chunks
+            USING hnsw (embedding vector_cosine_ops)
+            WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})
+        """, timeout=HNSW_BUILD_TIMEOUT)
+
+    @staticmethod
+    async def _embedding_dimensions(conn: asyncpg.Connection) -> int:
+        """Размерность колонки rag_chunks.embedding"""
+        return await conn.fetchval("""
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = 'rag_chunks'::regclass AND attname = 'embedding'
+        """)
+
+    async def reembed_chunks(self, embed: Callable[[List[str]], Awaitable[List[Optional[List[float]]]]],
+                             batch_size: int = 96):
+        """
+        Перенос чанков на текущую размерность эмбеддингов (после смены модели).
+        Тексты чанков заново проходят через embed пачками в новую колонку, затем она подменяет старую
+        и индекс строится заново. Уже перенесённые пачки сохраняются: прерванный перенос продолжается с того же места.
+        """
         async with self.pool.acquire() as conn:
-            doc_id = await conn.fetchval("""
-                INSERT INTO rag_documents (filename, file_hash, uploaded_by)
-                VALUES ($1, $2, $3)
-                RETURNING id
-            """, filename, file_hash, user_id)
-            return doc_id
-
-    async def add_chunk(self, document_id: int, chunk_index: int,
-                        content: str, embedding: List[float],
-                        metadata: Dict[str, Any] = None):
-        """Добавляет чанк с эмбеддингом в базу"""
+            await conn.execute(
+                f"ALTER TABLE rag_chunks ADD COLUMN IF NOT EXISTS embedding_new vector({EMBEDDING_DIMENSIONS})"
+            )
+            done = 0
+            while rows := await conn.fetch(
+                "SELECT id, content FROM rag_chunks WHERE embedding_new IS NULL ORDER BY id LIMIT $1", batch_size
+            ):
+                embeddings = await embed([row['content'] for row in rows])
+                if any(embedding is None for embedding in embeddings):
+                    raise RuntimeError(f"re-embedding failed after {done} chunks, will resume on next start")
+                await conn.executemany(
+                    "UPDATE rag_chunks SET embedding_new = $2 WHERE id = $1",
+                    [(row['id'], embedding) for row, embedding in zip(rows, embeddings)]
+                )
+                done += len(rows)
+                logger.info("Re-embedded %d chunks", done)
+
+            async with conn.transaction():
+                await conn.execute("DROP INDEX IF EXISTS rag_chunks_emb_hnsw")
+                await conn.execute("ALTER TABLE rag_chunks DROP COLUMN embedding")
+                await conn.execute("ALTER TABLE rag_chunks RENAME COLUMN embedding_new TO embedding")
+            await self._create_hnsw_index(conn)
+
+        # Подготовленные на других соединениях запросы ссылаются на старую колонку
+        await self.pool.expire_connections()
+        self.stored_dimensions = EMBEDDING_DIMENSIONS
+        self.index_version += 1
+        logger.info("✅ %d chunks moved to vector(%s)", done, EMBEDDING_DIMENSIONS)
+
+    async def _load_known_hashes(self):
+        """Загружает хеши всех документов в память"""
         async with self.pool.acquire() as conn:
-            # Преобразуем список в строку для pgvector
-            embedding_str = "[" + ",".join(map(str, embedding)) + "]"
-            metadata_json = json.dumps(metadata or {})
+            rows = await conn.fetch("SELECT file_hash FROM rag_documents")
+        self._known_hashes = {row['file_hash'] for row in rows}
+        logger.info("✅ Loaded %s document hashes", len(self._known_hashes))
 
-            await conn.execute("""
-                INSERT INTO rag_chunks (document_id, chunk_index, content, embedding, metadata)
-                VALUES ($1, $2, $3, $4::vector, $5::jsonb)
-            """, document_id, chunk_index, content, embedding_str, metadata_json)
+    def is_duplicate(self, file_hash: str) -> bool:
+        """Загружался ли уже файл с таким хешем (UNIQUE в таблице остаётся последней проверкой)"""
+        return file_hash in self._known_hashes
+
+    @asynccontextmanager
+    async def _acquire(self, conn: Optional[asyncpg.Connection] = None) -> AsyncIterator[asyncpg.Connection]:
+        """Переданное соединение (внутри транзакции загрузки) или новое из пула"""
+        if conn is not None:
+            yield conn
+        else:
+            async with self.pool.acquire() as conn:
+                yield conn
 
-    async def search_chunks(self, query_embedding: List[float], limit: int = 5) -> List[Dict]:
+    @asynccontextmanager
+    async def upload_transaction(self, file_hash: str) -> AsyncIterator[asyncpg.Connection]:
         """
-        Ищет похожие чанки по эмбеддингу.
-        Возвращает список чанков с оценкой схожести.
+        Одно соединение и одна транзакция на всю загрузку документа:
+        при ошибке в базе не остаётся документа с частью чанков, а его хеш снова не считается известным.
+        """
+        new_hash = file_hash not in self._known_hashes
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    yield conn
+        except BaseException:
+            if new_hash:
+                self._known_hashes.discard(file_hash)
+            raise
+        # Поиск, выполненный до фиксации, мог закэшироваться без новых чанков под текущей версией
+        self.index_version += 1
+
+    async def add_document(self, filename: str, file_hash: str, user_id: int,
+                           conn: Optional[asyncpg.Connection] = None) -> int:
+        """Добавляет документ в базу, возвращает ID"""
+        async with self._acquire(conn) as conn:
+            doc_id = await conn.fetchval(SQL_INSERT_DOCUMENT, filename, file_hash, user_id)
+        self._known_hashes.add(file_hash)
+        return doc_id
+
+    async def add_chunks_bulk(self, rows: List[Tuple[int, int, str, List[float], Dict[str, Any], str]],
+                              document_id: Optional[int] = None, total_chunks: Optional[int] = None,
+                              conn: Optional[asyncpg.Connection] = None):
+        """
+        Добавляет пачку чанков одной командой COPY (бинарный формат) на одном соединении.
+        rows: (document_id, chunk_index, content, embedding, metadata, content_hash)
+        document_id и total_chunks (для последней пачки документа) - в той же транзакции
+        записывает в документ итоговое число чанков.
         """
+        records = [
+            (doc_id, chunk_index, content, embedding, json.dumps(metadata or {}), content_hash)
+            for doc_id, chunk_index, content, embedding, metadata, content_hash in rows
+        ]
+        async with self._acquire(conn) as conn:
+            async with conn.transaction():
+                if records:
+                    await conn.copy_records_to_table(
+                        'rag_chunks',
+                        records=records,
+                        columns=('document_id', 'chunk_index', 'content', 'embedding', 'metadata', 'content_hash')
+                    )
+                if document_id is not None and total_chunks is not None:
+                    await conn.execute(SQL_SET_TOTAL_CHUNKS, total_chunks, document_id)
+        self.index_version += 1
+
+    async def find_embeddings(self, content_hashes: List[str]) -> Dict[str, Any]:
+        """Уже сохранённые эмбеддинги чанков с такими хешами текста: content_hash -> numpy-массив"""
         async with self.pool.acquire() as conn:
-            # Преобразуем эмбеддинг в строку для pgvector
-            embedding_str = "[" + ",".join(map(str, query_embedding)) + "]"
+            rows = await conn.fetch(SQL_FIND_EMBEDDINGS, content_hashes)
+        return {row['content_hash']: row['embedding'].to_numpy() for row in rows}
 
-            # Поиск по косинусному сходству (1 - distance = similarity)
-            rows = await conn.fetch("""
-                SELECT 
-                    c.id,
-                    c.content,
-                    c.metadata,
-                    d.filename,
-                    1 - (c.embedding <=> $1::vector) as similarity
-                FROM rag_chunks c
-                JOIN rag_documents d ON c.document_id = d.id
-                ORDER BY c.embedding <=> $1::vector
-                LIMIT $2
-            """, embedding_str, limit)
+    async def search_chunks(self, query_embedding: List[float], limit: int = 5,
+                            with_embeddings: bool = False) -> List[Dict]:
+        """
+        Ищет похожие чанки по эмбеддингу.
+        Возвращает список чанков с оценкой схожести
+        (with_embeddings=True - ещё и эмбеддинги чанков как numpy-массивы float32, для переранжирования).
+        """
+        query = SQL_SEARCH_CHUNKS_WITH_EMBEDDINGS if with_embeddings else SQL_SEARCH_CHUNKS
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(query, query_embedding, limit)
 
             results = []
             for row in rows:
-                results.append({
+                chunk = {
                     'id': row['id'],
                     'content': row['content'],
                     'metadata': json.loads(row['metadata']) if row['metadata'] else {},
                     'filename': row['filename'],
                     'similarity': float(row['similarity'])
-                })
+                }
+                if with_embeddings:
+                    chunk['embedding'] = row['embedding'].to_numpy()
+                results.append(chunk)
 
             return results
 
@@ -136,21 +381,16 @@ class RAGDatabase:
                         chunks_used: int, response_time_ms: int):
         """Логирует использование RAG системы"""
         async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO rag_usage_stats (user_id, query, chunks_used, response_time_ms)
-                VALUES ($1, $2, $3, $4)
-            """, user_id, query, chunks_used, response_time_ms)
+            await conn.execute(SQL_LOG_USAGE, user_id, query, chunks_used, response_time_ms)
 
     async def get_document_stats(self) -> Dict[str, Any]:
-        """Возвращает статистику документов"""
+        """
+        Возвращает статистику документов и запросов:
+        documents_count, chunks_count, queries_today, total_queries
+        """
         async with self.pool.acquire() as conn:
-            docs_count = await conn.fetchval("SELECT COUNT(*) FROM rag_documents")
-            chunks_count = await conn.fetchval("SELECT COUNT(*) FROM rag_chunks")
-
-            return {
-                'documents_count': docs_count or 0,
-                'chunks_count': chunks_count or 0
-            }
+            row = await conn.fetchrow(SQL_STATS)
+        return {key: value or 0 for key, value in row.items()}
 
     async def get_all_documents(self) -> List[Dict]:
         """Возвращает список всех документов"""
@@ -165,11 +405,15 @@ class RAGDatabase:
     async def delete_document(self, doc_id: int) -> bool:
         """Удаляет документ и все его чанки"""
         async with self.pool.acquire() as conn:
-            result = await conn.execute(
-                "DELETE FROM rag_documents WHERE id = $1",
+            file_hash = await conn.fetchval(
+                "DELETE FROM rag_documents WHERE id = $1 RETURNING file_hash",
                 doc_id
             )
-            return "DELETE 1" in result
+        self.index_version += 1
+        if file_hash is None:
+            return False
+        self._known_hashes.discard(file_hash)
+        return True
 
 
 # Глобальный экземпляр
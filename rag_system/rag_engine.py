@@ -3,11 +3,47 @@
 
 import asyncio
 import logging
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import numpy as np
+import tiktoken
+from cachetools import TTLCache
+from background import fire
 
 logger = logging.getLogger(__name__)
 
+# Сколько эмбеддингов вопросов храним в памяти (LRU)
+EMBED_CACHE_SIZE = 4096
+# Сколько токенов найденных чанков передаём модели (top_k чанков по 800 токенов помещаются целиком)
+CONTEXT_TOKEN_BUDGET = 4000
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    """Та же кодировка, по которой документы режутся на чанки"""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _mmr(query: np.ndarray, candidates: np.ndarray, k: int, lambda_: float) -> List[int]:
+    """
+    Maximal Marginal Relevance: выбирает k индексов кандидатов, похожих на вопрос,
+    но не повторяющих друг друга. query и строки candidates нормализованы.
+    """
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    # Для каждого кандидата - максимальное сходство с уже выбранными
+    redundancy = pairwise[selected[0]].copy()
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_ * relevance - (1 - lambda_) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, pairwise[best], out=redundancy)
+    return selected
+
 # Глобальный экземпляр движка
 rag_engine: Optional['RAGEngine'] = None
 
@@ -19,37 +55,115 @@ class RAGEngine:
         self.db = db  # RAGDatabase
         self.embedding_service = embedding_service  # EmbeddingService
         self.openai_assistant = openai_assistant  # OpenAIAssistant
-        self.similarity_threshold = 0.7 # Порог схожести для фильтрации
+        self.similarity_threshold = 0.4 # Порог схожести для фильтрации (у text-embedding-3 сходства ниже, чем у ada)
+        self.top_k = 4  # Сколько чанков берём из поиска
+        self.candidate_k = 20  # Сколько кандидатов достаём из БД для отбора MMR
+        self.mmr_lambda = 0.7  # 1 - только релевантность, 0 - только разнообразие
+        # Результаты поиска для одинаковых вопросов: (нормализованный вопрос, top_k, версия базы) -> чанки
+        self._retrieval_cache: TTLCache = TTLCache(maxsize=5000, ttl=600)
+        # Эмбеддинги вопросов: нормализованный вопрос -> эмбеддинг; не зависят от версии базы и не устаревают
+        self._embed_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
+# ========================== Поиск релевантных чанков ==============================
+
+    async def retrieve(
+            self,
+            query: str,
+            query_embedding: Optional[List[float]] = None,
+            top_k: Optional[int] = None
+    ) -> Optional[List[Dict]]:
+        """
+        Возвращает чанки со схожестью не ниже порога (с кэшем на 10 минут).
+        None - если не удалось создать эмбеддинг запроса.
+        """
+        top_k = top_k or self.top_k
+        normalized = " ".join(query.lower().split())
+        key = (normalized, top_k, self.db.index_version)
+        chunks = self._retrieval_cache.get(key)
+        if chunks is not None:
+            return chunks
+
+        query_embedding = await self._query_embedding(normalized, query, query_embedding)
+        if query_embedding is None:
+            return None
+
+        candidates = await self.db.search_chunks(
+            query_embedding, limit=max(top_k, self.candidate_k), with_embeddings=True
+        )
+        chunks = self._select_chunks(query_embedding, candidates, top_k)
+        self._retrieval_cache[key] = chunks
+        return chunks
+
+    def _select_chunks(self, query_embedding: List[float], candidates: List[Dict], top_k: int) -> List[Dict]:
+        """Отсекает кандидатов ниже порога схожести и отбирает top_k по MMR одной матричной операцией"""
+        if not candidates:
+            return []
+
+        embeddings = np.vstack([chunk.pop('embedding') for chunk in candidates]).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query)
+
+        similarities = embeddings @ query
+        passed = np.flatnonzero(similarities >= self.similarity_threshold)
+        if not passed.size:
+            return []
+
+        selected = passed[_mmr(query, embeddings[passed], top_k, self.mmr_lambda)]
+        chunks = []
+        for i in selected:
+            chunk = candidates[i]
+            chunk['similarity'] = float(similarities[i])
+            chunks.append(chunk)
+        return chunks
+
+    async def _query_embedding(
+            self,
+            normalized: str,
+            query: str,
+            query_embedding: Optional[List[float]] = None
+    ) -> Optional[List[float]]:
+        """Эмбеддинг вопроса из LRU-кэша; при промахе - готовый (если передан) или новый запрос к API"""
+        cached = self._embed_cache.get(normalized)
+        if cached is not None:
+            self._embed_cache.move_to_end(normalized)
+            return cached
+
+        if query_embedding is None:
+            query_embedding = await self.embedding_service.create_embedding(query)
+        if query_embedding is None:
+            return None
+
+        self._embed_cache[normalized] = query_embedding
+        if len(self._embed_cache) > EMBED_CACHE_SIZE:
+            self._embed_cache.popitem(last=False)
+        return query_embedding
 
 # ========================== Обработка запроса через RAG ==============================
 
-    async def process_query(self, query: str, user_id: int, history: Optional[List[Dict]] = None) -> Optional[Dict[str, Any]]:
+    async def process_query(
+            self,
+            query: str,
+            user_id: int,
+            history: Optional[List[Dict]] = None,
+            query_embedding: Optional[List[float]] = None,
+            summary: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
         """
         Обрабатывает запрос пользователя через RAG.
-        1. Создаёт эмбеддинг запроса
-        2. Ищет похожие чанки в базе
-        3. Формирует контекст и отправляет в ИИ
+        1-3. Находит чанки выше порога схожести (эмбеддинг + поиск, с кэшем результатов)
+        4-7. Формирует контекст и отправляет в ИИ
         """
         start_time = datetime.now()
 
         try:
-            # 1. Создаём эмбеддинг запроса
-            query_embedding = await self.embedding_service.create_embedding(query)
+            relevant_chunks = await self.retrieve(query, query_embedding)
 
             # Если эмбеддинг не создался - используем обычный ИИ
-            if query_embedding is None:
+            if relevant_chunks is None:
                 logger.warning("Не удалось создать эмбеддинг запроса")
                 return
 
-            # 2. Ищем релевантные чанки в базе
-            chunks = await self.db.search_chunks(query_embedding, limit=4)
-
-            # 3. Фильтруем по порогу схожести
-            relevant_chunks = [
-                chunk for chunk in chunks
-                if chunk['similarity'] >= self.similarity_threshold
-            ]
-
             # 4. Если нет релевантных чанков - используем обычный ИИ
             if not relevant_chunks:
                 logger.info("Нет релевантных чанков, используем обычный ИИ")
@@ -66,7 +180,8 @@ class RAGEngine:
                 user_message=prompt,
                 user_id=user_id,
                 history=history,
-                RAG=True
+                RAG=True,
+                summary=summary
             )
 
             # 8. Очищаем ответ от технических меток
@@ -74,13 +189,13 @@ class RAGEngine:
 
             response_time = int((datetime.now() - start_time).total_seconds() * 1000)
 
-            # 9. Логируем использование RAG
-            await self.db.log_usage(
+            # 9. Логируем использование RAG в фоне: ответ пользователю не ждёт записи статистики
+            fire(self.db.log_usage(
                 user_id=user_id,
                 query=query,
                 chunks_used=len(relevant_chunks),
                 response_time_ms=response_time
-            )
+            ))
 
             return {
                 'success': True,
@@ -92,19 +207,24 @@ class RAGEngine:
             }
 
         except Exception as e:
-            logger.error(f"Ошибка обработки RAG запроса: {e}")
+            logger.error("Ошибка обработки RAG запроса: %s", e)
             return None
 
 # ========================== Формирует контекст из найденных чанков ==============================
 
     def _build_context(self, chunks: List[Dict]) -> str:
-        """Формирует контекст из найденных чанков"""
+        """Формирует контекст из найденных чанков (самые релевантные первыми) в пределах CONTEXT_TOKEN_BUDGET"""
         context_parts = []
+        budget = CONTEXT_TOKEN_BUDGET
         for i, chunk in enumerate(chunks):
+            if budget <= 0:
+                break
             content = chunk['content']
-            # Обрезаем слишком длинные чанки
-            if len(content) > 500:
-                content = content[:500] + "..."
+            tokens = _encoding().encode(content, disallowed_special=())
+            # Чанк, который не помещается в остаток бюджета, обрезаем по токенам
+            if len(tokens) > budget:
+                content = _encoding().decode(tokens[:budget]) + "..."
+            budget -= len(tokens)
 
             source = chunk.get('filename', f'Документ {i + 1}')
             similarity = chunk.get('similarity', 0)
@@ -140,29 +260,16 @@ USER QUESTION:
     async def get_stats(self) -> Dict[str, Any]:
         """Получает статистику RAG системы"""
         try:
+            # Документы, чанки и запросы (за сегодня и всего) - одним запросом к БД
             db_stats = await self.db.get_document_stats()
 
-            async with self.db.pool.acquire() as conn:
-                # Запросы за сегодня
-                today_usage = await conn.fetchval("""
-                    SELECT COUNT(*) FROM rag_usage_stats 
-                    WHERE DATE(created_at) = CURRENT_DATE
-                """)
-
-                # Всего запросов
-                total_usage = await conn.fetchval("""
-                    SELECT COUNT(*) FROM rag_usage_stats
-                """)
-
             return {
                 **db_stats,
-                'queries_today': today_usage or 0,
-                'total_queries': total_usage or 0,
                 'status': 'active'
             }
 
         except Exception as e:
-            logger.error(f"Ошибка получения статистики: {e}")
+            logger.error("Ошибка получения статистики: %s", e)
             return {'error': str(e)}
 
 
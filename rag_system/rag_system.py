@@ -3,16 +3,51 @@
 
 import logging
 import asyncio
+import asyncpg
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Union
+from urllib.parse import urlsplit
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from rag_system.rag_database import RAGDatabase
+from rag_system.embedding_service import EMBEDDING_DIMENSIONS, EmbeddingService
+from rag_system.embedding_cache import CachedEmbeddingService
+from rag_system.document_uploader import DocumentUploader, shutdown_process_pool
+from rag_system.rag_engine import RAGEngine, init_rag_engine
 logger = logging.getLogger(__name__)
 
-# Глобальные переменные для компонентов RAG
-rag_db = None  # База данных RAG
-embedding_service = None  # Сервис эмбеддингов
-document_uploader = None  # Загрузчик документов
-rag_engine = None  # Движок RAG
+# Подключение к RAG БД: сколько попыток и какие ошибки считаем временными.
+# Остальные (неверный DSN, пароль, имя БД) повтором не лечатся - падаем сразу
+DB_CONNECT_ATTEMPTS = 5
+TRANSIENT_DB_ERRORS = (
+    OSError,  # в том числе ConnectionRefusedError: БД ещё не слушает порт
+    asyncio.TimeoutError,
+    asyncpg.CannotConnectNowError,  # БД стартует или восстанавливается
+    asyncpg.TooManyConnectionsError,
+    asyncpg.ConnectionDoesNotExistError,
+)
+# Сколько ждём пробное подключение перед циклом повторов
+PREFLIGHT_TIMEOUT = 0.5
 
 
-async def init_rag_system(settings, ai_assistant):
+class RagDisabled(Exception):
+    """RAG выключен в настройках"""
+
+
+class RagInitError(Exception):
+    """RAG включён, но не поднялся (нет DSN, БД или API недоступны); исходная ошибка - в __cause__"""
+
+
+@dataclass(slots=True)
+class RagContext:
+    """Компоненты одной RAG системы; создаётся в init_rag_system и передаётся тем, кто ими пользуется"""
+    db: RAGDatabase
+    embedding_service: Union[EmbeddingService, CachedEmbeddingService]
+    uploader: DocumentUploader
+    engine: RAGEngine
+
+
+async def init_rag_system(settings, ai_assistant) -> RagContext:
     """
     Инициализирует всю RAG систему.
     Вызывается из main.py при запуске бота.
@@ -20,84 +55,180 @@ async def init_rag_system(settings, ai_assistant):
     Параметры:
         settings: объект настроек из config.py
         ai_assistant: инициализированный OpenAI ассистент
+
+    Возвращает RagContext; RagDisabled - RAG выключен, RagInitError - не поднялся.
+    Что делать без RAG, решает вызывающий код.
+    Закрывать через close_rag_system; удобнее через контекстный менеджер rag_system.
     """
-    global rag_db, embedding_service, document_uploader, rag_engine
+    # Все нужные настройки читаем один раз, дальше функции получают готовые значения
+    dsn = settings.POSTGRES_PORT_RAG
+    cache_path = settings.EMBEDDING_CACHE_PATH
+
+    # Проверяем настройки
+    if not settings.RAG_ENABLED:
+        raise RagDisabled()
 
+    if not dsn:
+        raise RagInitError("DATABASE_URL не задан для RAG")
+
+    rag_db = embedding_service = None
     try:
-        # Проверяем настройки
-        if not settings.RAG_ENABLED:
-            logger.info("RAG отключён в настройках")
-            return False
-
-        if not settings.POSTGRES_PORT_RAG:
-            logger.error("DATABASE_URL не задан для RAG")
-            return False
-
-        # 1. Инициализируем БД для RAG
-        from rag_system.rag_database import RAGDatabase
-        rag_db = RAGDatabase(settings.POSTGRES_PORT_RAG)
-        # Добавляем повторные попытки с экспоненциальной задержкой
-        max_retries = 5
-        retry_delay = 2
-
-        for attempt in range(max_retries):
-            try:
-                await rag_db.connect()
-                break  # Успешно подключились
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (2 ** attempt)  # Экспоненциальная задержка
-                    logger.warning(f"⏳ Попытка {attempt + 1}/{max_retries} подключения к RAG БД не удалась. "
-                                   f"Ожидание {wait_time}с... Ошибка: {e}")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.error(f"❌ Не удалось подключиться к RAG БД после {max_retries} попыток")
-                    raise
-
-        logger.info("✅ RAG база данных подключена")
-        # await rag_db.connect()
-        # logger.info("✅ RAG база данных подключена")
-
-        # 2. Инициализируем сервис эмбеддингов
-        from rag_system.embedding_service import EmbeddingService
-        embedding_service = EmbeddingService(settings.OPENAI_API_KEY)
-        logger.info("✅ Сервис эмбеддингов инициализирован")
+        # Политику цикла (uvloop) выставляет main.py до asyncio.run; здесь цикл уже запущен, только проверяем
+        loop = asyncio.get_running_loop()
+        logger.info("RAG работает на цикле событий %s.%s", type(loop).__module__, type(loop).__name__)
+
+        # 1-2. БД (с повторами) и сервис эмбеддингов (с прогревом соединения) не зависят друг от друга
+        db_task = asyncio.create_task(
+            _init_db(dsn, settings.POSTGRES_POOL_MIN_RAG, settings.POSTGRES_POOL_MAX_RAG)
+        )
+        embeddings_task = asyncio.create_task(_init_embeddings(settings.OPENAI_API_KEY, cache_path))
+        try:
+            rag_db, embedding_service = await asyncio.gather(db_task, embeddings_task)
+        except BaseException:
+            # Как в TaskGroup (Python 3.11+): при ошибке одной задачи вторая отменяется,
+            # а то, что она успела поднять, закрывается ниже вместе со всем остальным
+            for task in (db_task, embeddings_task):
+                task.cancel()
+            await asyncio.wait((db_task, embeddings_task))
+            rag_db, embedding_service = _task_result(db_task), _task_result(embeddings_task)
+            raise
+
+        # Чанки сохранены под прежнюю модель эмбеддингов: переносим до того, как по ним начнётся поиск
+        if rag_db.needs_reembedding:
+            if not settings.RAG_REEMBED:
+                raise RuntimeError(
+                    f"чанки сохранены как vector({rag_db.stored_dimensions}), нужен перенос: включите RAG_REEMBED"
+                )
+            logger.warning("⏳ Пересчёт эмбеддингов базы знаний под vector(%s)...", EMBEDDING_DIMENSIONS)
+            await rag_db.reembed_chunks(embedding_service.create_embeddings_batch, settings.RAG_BATCH_SIZE)
 
         # 3. Инициализируем загрузчик документов
-        from rag_system.document_uploader import DocumentUploader
-        document_uploader = DocumentUploader(rag_db, embedding_service)
+        document_uploader = DocumentUploader(rag_db, embedding_service, batch_size=settings.RAG_BATCH_SIZE)
         logger.info("✅ Загрузчик документов инициализирован")
 
         # 4. Инициализируем RAG движок
-        from rag_system.rag_engine import init_rag_engine
         rag_engine = await init_rag_engine(rag_db, embedding_service, ai_assistant)
         logger.info("✅ RAG движок инициализирован")
 
         # 5. Логируем статистику
         stats = await rag_engine.get_stats()
-        logger.info(f"📊 RAG статистика: документов={stats.get('documents_count', 0)}, "
-                    f"чанков={stats.get('chunks_count', 0)}")
+        logger.info("📊 RAG статистика: документов=%s, чанков=%s",
+                    stats.get('documents_count', 0), stats.get('chunks_count', 0))
 
-        return True
+        return RagContext(rag_db, embedding_service, document_uploader, rag_engine)
 
     except Exception as e:
-        logger.error(f"❌ Ошибка инициализации RAG системы: {e}")
-        return False
+        # Настройки в лог целиком не пишем (там ключ API и пароль БД): только куда подключались
+        logger.error("❌ Ошибка инициализации RAG системы (БД %s, кэш эмбеддингов %s): %s",
+                     _dsn_for_log(dsn), cache_path or 'выключен', e)
+        # То, что успело подняться, закрываем сразу: иначе пул висит до перезапуска процесса
+        if rag_db is not None:
+            await rag_db.close()
+        if embedding_service is not None:
+            await embedding_service.aclose()
+        raise RagInitError(str(e)) from e
+
+
+def _task_result(task: asyncio.Task):
+    """Результат завершённой задачи или None, если она упала или была отменена"""
+    if task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+
+def _dsn_for_log(dsn: str) -> str:
+    """DSN без логина и пароля: хост, порт и имя БД"""
+    url = urlsplit(dsn)
+    return url._replace(netloc=url.netloc.rpartition('@')[2]).geturl()
+
+
+async def _init_db(dsn: str, min_size: int, max_size: int):
+    """
+    Подключает БД для RAG с повторными попытками.
+    Задержка экспоненциальная со случайным разбросом: перезапущенные экземпляры бота не ломятся в БД одновременно.
+    """
+    db = RAGDatabase(dsn, min_size=min_size, max_size=max_size)
+
+    def log_retry(state):
+        logger.warning("⏳ Попытка %d/%d подключения к RAG БД не удалась. Ожидание %.1fс... Ошибка: %s",
+                       state.attempt_number, DB_CONNECT_ATTEMPTS, state.next_action.sleep, state.outcome.exception())
+
+    await _preflight(dsn)
+
+    try:
+        async for attempt in AsyncRetrying(
+                wait=wait_random_exponential(multiplier=2, max=60),
+                stop=stop_after_attempt(DB_CONNECT_ATTEMPTS),
+                retry=retry_if_exception_type(TRANSIENT_DB_ERRORS),
+                before_sleep=log_retry,
+                reraise=True
+        ):
+            with attempt:
+                await db.connect()
+        await db.prewarm()
+    except BaseException as e:
+        # В том числе отмена из init_rag_system: созданный пул не должен пережить задачу
+        if isinstance(e, TRANSIENT_DB_ERRORS):
+            logger.error("❌ Не удалось подключиться к RAG БД после %d попыток", DB_CONNECT_ATTEMPTS)
+        await db.close()
+        raise
+    logger.info("✅ RAG база данных подключена")
+    return db
+
+
+async def _preflight(dsn: str):
+    """
+    Быстрая проверка DSN до цикла повторов: разбор адреса и одно короткое подключение.
+    Ошибки конфигурации всплывают сразу, а не после минуты пауз; временные оставляем циклу повторов.
+    """
+    url = urlsplit(dsn)
+    if url.scheme not in ('postgres', 'postgresql'):
+        raise ValueError(f"DSN RAG БД должен начинаться с postgresql://, получено: {url.scheme or 'пусто'}://")
+    url.port  # ValueError, если порт не число
+
+    try:
+        conn = await asyncio.wait_for(asyncpg.connect(dsn), timeout=PREFLIGHT_TIMEOUT)
+    except TRANSIENT_DB_ERRORS as e:
+        logger.warning("⏳ RAG БД пока недоступна (%s), переходим к повторам", type(e).__name__)
+        return
+    await conn.close()
+
+
+async def _init_embeddings(api_key: str, cache_path: str):
+    """Создаёт сервис эмбеддингов (с кэшем на диске, если задан путь) и заранее открывает соединение с API"""
+    service = EmbeddingService(api_key)
+    try:
+        if cache_path:
+            service = CachedEmbeddingService(service, cache_path)
+        await service.warmup()
+    except BaseException:
+        await service.aclose()
+        raise
+    logger.info("✅ Сервис эмбеддингов инициализирован")
+    return service
 
 
-async def close_rag_system():
+async def close_rag_system(ctx: RagContext):
     """Закрывает соединения RAG системы"""
-    global rag_db
-    if rag_db and rag_db.pool:
-        await rag_db.pool.close()
+    if ctx.db.pool:
+        await ctx.db.close()
         logger.info("✅ RAG соединения закрыты")
+    await ctx.embedding_service.aclose()
 
+    shutdown_process_pool()
 
-def get_rag_components():
-    """Возвращает все компоненты RAG системы"""
-    return {
-        'db': rag_db,
-        'embedding_service': embedding_service,
-        'document_uploader': document_uploader,
-        'rag_engine': rag_engine
-    }
\ No newline at end of file
+
+@asynccontextmanager
+async def rag_system(settings, ai_assistant) -> AsyncIterator[RagContext]:
+    """
+    Поднимает RAG систему на время блока и закрывает её при любом выходе из него.
+    Ошибки запуска - те же RagDisabled / RagInitError, что у init_rag_system.
+    """
+    ctx = await init_rag_system(settings, ai_assistant)
+    try:
+        yield ctx
+    finally:
+        try:
+            await close_rag_system(ctx)
+        except Exception as e:
+            logger.error("Ошибка закрытия RAG: %s", e)
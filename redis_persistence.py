@@ -0,0 +1,100 @@
+# redis_persistence.py
+# Хранение context.user_data (история диалога с ИИ и т.п.) в Redis вместо памяти процесса
+
+import json
+import logging
+from typing import Any, Dict, Optional, Set
+
+from redis.asyncio import Redis
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Persistence для python-telegram-bot: только user_data, по ключу на пользователя
+    (<prefix>:ud:<user_id>, JSON) с TTL. Остальные данные бот не хранит.
+    При запуске ничего не читается: данные пользователя подгружаются из Redis при его первом апдейте.
+    """
+
+    def __init__(self, url: str, prefix: str = "voltic_bot", ttl: int = 24 * 3600, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.redis = Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.ttl = ttl
+        # Пользователи, чьи данные уже подгружены из Redis в память процесса
+        self._loaded: Set[int] = set()
+
+    def _key(self, user_id: Any) -> str:
+        return f"{self.prefix}:ud:{user_id}"
+
+# ========================== user_data ==============================
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        """При запуске ничего не загружаем: память и время старта не растут с числом пользователей"""
+        return {}
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        """Сохраняет user_data пользователя и продлевает TTL"""
+        await self.redis.set(self._key(user_id), json.dumps(data, ensure_ascii=False), ex=self.ttl)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        """
+        Вызывается перед обработкой каждого апдейта пользователя.
+        Первый раз подгружает его данные из Redis; дальше актуальна копия в памяти процесса.
+        """
+        if user_id in self._loaded:
+            return
+        raw = await self.redis.get(self._key(user_id))
+        if raw:
+            # Записанное в памяти до подгрузки (если успели) важнее сохранённого
+            user_data.update({**json.loads(raw), **user_data})
+        self._loaded.add(user_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.redis.delete(self._key(user_id))
+        self._loaded.discard(user_id)
+
+    async def flush(self) -> None:
+        """Вызывается при остановке бота после последнего сохранения"""
+        await self.redis.aclose()
+        logger.info("✅ Redis persistence closed")
+
+# ========================== Не используются (store_data выключен) ==============================
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
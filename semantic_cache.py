@@ -0,0 +1,130 @@
+# semantic_cache.py
+# Семантический кэш ответов ИИ: похожий по смыслу вопрос того же пользователя
+# получает сохранённый ответ без нового запроса к модели
+
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Entry:
+    vector: np.ndarray  # нормализованный эмбеддинг вопроса (float32)
+    response: str
+    created_at: float
+    hits: int = 0
+
+    @property
+    def size(self) -> int:
+        return self.vector.nbytes + len(self.response.encode('utf-8'))
+
+
+class CacheHit(NamedTuple):
+    response: str
+    similarity: float
+
+
+class SemanticCache:
+    """
+    Кэш (эмбеддинг вопроса -> ответ) отдельно для каждого пользователя.
+    Поиск - точное косинусное сходство по записям пользователя (их немного, индекс не нужен).
+    Вытеснение: по TTL и по общему объёму, первыми уходят давно неактивные пользователи.
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.9,
+            ttl: float = 24 * 3600,
+            max_bytes: int = 100 * 1024 * 1024,
+            max_entries_per_user: int = 64
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries_per_user = max_entries_per_user
+        # user_id -> записи пользователя; порядок ключей - LRU по пользователям
+        self._users: "OrderedDict[int, List[_Entry]]" = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        return vector / norm
+
+    def _drop_expired(self, user_id: int, entries: List[_Entry], now: float) -> List[_Entry]:
+        alive = [e for e in entries if now - e.created_at < self.ttl]
+        if len(alive) != len(entries):
+            self._bytes -= sum(e.size for e in entries) - sum(e.size for e in alive)
+            if alive:
+                self._users[user_id] = alive
+            else:
+                del self._users[user_id]
+        return alive
+
+    def lookup(self, user_id: int, embedding: List[float], threshold: Optional[float] = None) -> Optional[CacheHit]:
+        """Возвращает сохранённый ответ на самый похожий вопрос, если сходство не ниже порога"""
+        entries = self._users.get(user_id)
+        if not entries:
+            return None
+
+        entries = self._drop_expired(user_id, entries, time.monotonic())
+        query = self._normalize(embedding)
+        if not entries or query is None:
+            return None
+
+        similarities = np.stack([e.vector for e in entries]) @ query
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < (self.threshold if threshold is None else threshold):
+            return None
+
+        entry = entries[best]
+        entry.hits += 1
+        self._users.move_to_end(user_id)
+        return CacheHit(entry.response, similarity)
+
+    def put(self, user_id: int, embedding: List[float], response: str) -> None:
+        """Сохраняет ответ на вопрос пользователя"""
+        vector = self._normalize(embedding)
+        if vector is None or not response:
+            return
+
+        entry = _Entry(vector=vector, response=response, created_at=time.monotonic())
+        entries = self._users.setdefault(user_id, [])
+        entries.append(entry)
+        self._bytes += entry.size
+        self._users.move_to_end(user_id)
+
+        # Ограничение на пользователя: выкидываем самые старые записи
+        if len(entries) > self.max_entries_per_user:
+            removed = entries[:-self.max_entries_per_user]
+            del entries[:-self.max_entries_per_user]
+            self._bytes -= sum(e.size for e in removed)
+
+        self._evict()
+
+    def _evict(self) -> None:
+        """Освобождает место, начиная с давно неактивных пользователей"""
+        while self._bytes > self.max_bytes and self._users:
+            user_id, entries = next(iter(self._users.items()))
+            removed = entries.pop(0)
+            self._bytes -= removed.size
+            if not entries:
+                del self._users[user_id]
+
+    def stats(self) -> Dict[str, int]:
+        """Размер кэша для логов и админских команд"""
+        return {
+            'users': len(self._users),
+            'entries': sum(len(e) for e in self._users.values()),
+            'bytes': self._bytes
+        }